@@ -0,0 +1,9 @@
+# gunicorn.conf.py
+# gunicorn 啟動時自動讀取目前目錄的這個檔案（例如 gunicorn main:app）
+# worker 收到 SIGTERM 時 gunicorn 會等進行中的請求完成，結束前在 worker 中把背景工作處理完：
+# 非同步 webhook 佇列中已回 200 的事件、write_behind 快取、沒用完的流水號與代碼、outbox
+
+
+def worker_exit(server, worker):
+    import main
+    main.shutdown_background_tasks()
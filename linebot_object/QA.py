@@ -1,14 +1,78 @@
 # qa_module.py
+import contextvars
 import os
-from openai import OpenAI
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from linebot.models import FlexSendMessage
 from dotenv import load_dotenv
+from linebot_object.answer_cache import AnswerCache
+from linebot_object.vector_index import LocalVectorIndex
+from linebot_object.embedding_cache import embed_with_cache, get_embedding_cache
+from linebot_object.metrics import Counter, Histogram, REGISTRY, timed
+from linebot_object.tracing import traced
 
 load_dotenv()
-# 初始化 OpenAI
-OpenAI_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# QA 後端：openai（正式環境）或 fake（離線壓測，使用 fake_backend 的假 client 與記憶體 collection）
+QA_BACKEND = os.getenv("QA_BACKEND", "openai").lower()
+# OpenAI client 在第一次使用時才建立（import openai 需要將近一秒，不拖慢啟動）
+OpenAI_client = None
+openai_client_lock = threading.Lock()
+if QA_BACKEND == "fake":
+    from linebot_object.fake_backend import FakeOpenAIClient
+    # 假 embedding 不能寫進正式的 embedding 快取檔
+    os.environ["EMBEDDING_CACHE_PATH"] = ""
+    OpenAI_client = FakeOpenAIClient()
 qa_collection = None  # 由 app.py 初始化時注入
 
+# 回答快取：相同或極相近的問題直接回傳先前生成的回答（QA_ANSWER_CACHE_SIZE=0 可關閉）
+answer_cache = AnswerCache(
+    max_size=int(os.getenv("QA_ANSWER_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("QA_ANSWER_CACHE_TTL", 3600)),
+    similarity_threshold=float(os.getenv("QA_ANSWER_CACHE_THRESHOLD", 0.95))
+)
+
+# 向量搜尋後端：atlas（$vectorSearch）或 local（啟動時載入本機矩陣）
+QA_VECTOR_BACKEND = os.getenv("QA_VECTOR_BACKEND", "atlas").lower()
+local_index = LocalVectorIndex()
+
+# qa_vectors 版本：push_vector_to_mongoDB.py 重建或同步後遞增 qa_meta 中的版本，
+# 執行中的 bot 每 QA_VECTORS_CHECK_INTERVAL 秒比對一次，改變時重新載入本機索引並清空回答快取（0 關閉）
+QA_VECTORS_CHECK_INTERVAL = float(os.getenv("QA_VECTORS_CHECK_INTERVAL", 30))
+QA_VECTORS_VERSION_ID = "qa_vectors"
+qa_meta_collection = None
+qa_vectors_version = None
+version_watcher = None
+
+# 推測式重寫：直接搜尋的同時就先送出重寫問題的 LLM 請求，直接命中時丟棄重寫結果
+# 未命中時少等一次 LLM round-trip，代價是命中時多花一次重寫的 token
+QA_SPECULATIVE_REWRITE = os.getenv("QA_SPECULATIVE_REWRITE", "false").lower() == "true"
+rewrite_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("QA_REWRITE_WORKERS", 8)), thread_name_prefix="qa-rewrite"
+) if QA_SPECULATIVE_REWRITE else None
+speculative_lock = threading.Lock()
+speculative_stats = {
+    "speculative_rewrites": 0,
+    "rewrites_used": 0,
+    "rewrites_wasted": 0,
+    "rewrites_cancelled": 0,
+    "wasted_tokens": 0,
+}
+
+# 串流生成：逐段接收回答，記錄第一個 token 的時間（TTFT）與總生成時間
+QA_STREAMING = os.getenv("QA_STREAMING", "false").lower() == "true"
+generation_lock = threading.Lock()
+generation_timings = deque(maxlen=1000)  # (ttft 秒數或 None, 總秒數)
+
+# 指標：各階段耗時、回答來源（快取命中 / 直接命中 / 重寫後命中 / 找不到 / 錯誤）
+QA_STAGE_SECONDS = Histogram("linebot_qa_stage_seconds", "QA 流程各階段耗時（秒）", ["stage"])
+QA_ANSWERS = Counter("linebot_qa_answers_total", "QA 回答來源", ["source"])
+QA_ERRORS = Counter("linebot_qa_errors_total", "embedding / 向量搜尋 / LLM 呼叫失敗次數", ["call"])
+REGISTRY.register_stats("linebot_qa_answer_cache", lambda: answer_cache.get_stats(), "QA 回答快取")
+REGISTRY.register_stats("linebot_embedding_cache", lambda: get_embedding_cache().get_stats(), "Embedding 快取")
+REGISTRY.register_stats("linebot_qa_speculative", lambda: get_speculative_stats(), "推測式重寫")
+
 def build_talk_to_me_message(alt_text , title , desc):
     flex_content = {
         "type": "bubble",
@@ -65,34 +129,85 @@ def build_evaluation_message():
     }
     
     return FlexSendMessage(alt_text="請評價回答", contents=flex_content)
-def init_qa_collection(collection):
-    """讓 app.py 初始化 MongoDB collection"""
-    global qa_collection
+def init_qa_collection(collection, meta_collection=None):
+    """讓 app.py 初始化 MongoDB collection；meta_collection 為記錄 qa_vectors 版本的集合（qa_meta）"""
+    global qa_collection, qa_meta_collection, qa_vectors_version, version_watcher
     qa_collection = collection
+    qa_meta_collection = meta_collection
+    # 先讀版本再載入，載入期間版本又改變時，下一次檢查會再載入一次
+    qa_vectors_version = get_qa_vectors_version()
+    reload_qa_vectors()
+    if meta_collection is not None and QA_VECTORS_CHECK_INTERVAL > 0 and version_watcher is None:
+        version_watcher = threading.Thread(target=_version_watch_loop, name="qa-vectors-watcher", daemon=True)
+        version_watcher.start()
+
+def get_qa_vectors_version():
+    """qa_meta 中記錄的 qa_vectors 版本，沒有記錄或讀取失敗時回傳 None"""
+    if qa_meta_collection is None:
+        return None
+    try:
+        doc = qa_meta_collection.find_one({"_id": QA_VECTORS_VERSION_ID})
+    except Exception as e:
+        print(f"讀取 qa_vectors 版本失敗: {e}")
+        return None
+    return doc.get("version") if doc else None
 
+def check_qa_vectors_version():
+    """版本與上次載入時不同就重新載入，回傳是否重新載入"""
+    global qa_vectors_version
+    version = get_qa_vectors_version()
+    if version is None or version == qa_vectors_version:
+        return False
+    print(f"qa_vectors 已更新（版本 {qa_vectors_version} → {version}），重新載入")
+    qa_vectors_version = version
+    reload_qa_vectors()
+    return True
+
+def _version_watch_loop():
+    while True:
+        time.sleep(QA_VECTORS_CHECK_INTERVAL)
+        check_qa_vectors_version()
+
+def get_openai_client():
+    """取得 OpenAI client，第一次呼叫時才 import 並初始化"""
+    global OpenAI_client
+    if OpenAI_client is None:
+        with openai_client_lock:
+            if OpenAI_client is None:
+                from openai import OpenAI
+                OpenAI_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return OpenAI_client
+
+def set_backend(openai_client=None, collection=None):
+    """替換 OpenAI client 與 QA collection（例如換成 fake_backend 做壓測），未指定的維持原本的"""
+    global OpenAI_client
+    if openai_client is not None:
+        OpenAI_client = openai_client
+    if collection is not None:
+        init_qa_collection(collection)
+
+def reload_qa_vectors():
+    """qa_vectors 內容更新後呼叫，重新載入本機索引並讓快取的舊回答失效"""
+    if QA_VECTOR_BACKEND == "local" and qa_collection is not None:
+        try:
+            local_index.load(qa_collection)
+        except Exception as e:
+            print(f"本機向量索引載入失敗，改用 Atlas 搜尋: {e}")
+    answer_cache.invalidate()
+
+@timed(QA_STAGE_SECONDS, stage="embed")
+@traced("qa.embed")
 def embed_text(text):
-    """使用 OpenAI embedding 生成向量"""
+    """使用 OpenAI embedding 生成向量（先查 embedding 快取）"""
     try:
-        response = OpenAI_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
+        return embed_with_cache(get_openai_client(), text)
     except Exception as e:
+        QA_ERRORS.labels(call="embed").inc()
         print(f"生成向量錯誤: {e}")
         return None
 
-def vector_search(query, limit=3, threshold=0.7):
-    """向量搜尋"""
-    if qa_collection is None:
-        print("QA collection 尚未初始化")
-        return []
-        
-    query_embedding = embed_text(query)
-    if query_embedding is None:
-        return []
-    
-    pipeline = [
+def build_vector_search_pipeline(query_embedding, limit):
+    return [
         {
             "$vectorSearch": {
                 "index": "GDG_welcome_RAG",
@@ -111,17 +226,36 @@ def vector_search(query, limit=3, threshold=0.7):
             }
         }
     ]
+
+@timed(QA_STAGE_SECONDS, stage="vector_search")
+@traced("qa.vector_search")
+def vector_search(query, limit=3, threshold=0.7, query_embedding=None):
+    """向量搜尋，已經算好 query_embedding 時可直接傳入"""
+    if qa_collection is None:
+        print("QA collection 尚未初始化")
+        return []
+        
+    if query_embedding is None:
+        query_embedding = embed_text(query)
+    if query_embedding is None:
+        return []
+
+    if QA_VECTOR_BACKEND == "local" and local_index.is_loaded():
+        results = local_index.search(query_embedding, limit=limit)
+        return [r for r in results if r.get('score', 0) >= threshold]
+    
+    pipeline = build_vector_search_pipeline(query_embedding, limit)
     
     try:
         results = list(qa_collection.aggregate(pipeline))
         return [r for r in results if r.get('score', 0) >= threshold]
     except Exception as e:
+        QA_ERRORS.labels(call="vector_search").inc()
         print(f"向量搜尋錯誤: {e}")
         return []
 
-def llm_rewrite_query(user_query):
-    """LLM 幫忙重寫問題"""
-    prompt = f"""
+def build_rewrite_prompt(user_query):
+    return f"""
     使用者問題: {user_query}
     
     請判斷這個問題最相關的 QA 標籤，從以下選項中選擇：
@@ -134,32 +268,53 @@ def llm_rewrite_query(user_query):
     只回傳「標籤 + 原先問題」。
     例如: "社員能力要求 + 我是資工系大一我應該怎麼辦"
     """
+
+def llm_rewrite_query(user_query):
+    """LLM 幫忙重寫問題"""
+    return llm_rewrite_query_with_usage(user_query)[0]
+
+@timed(QA_STAGE_SECONDS, stage="rewrite")
+@traced("qa.rewrite")
+def llm_rewrite_query_with_usage(user_query):
+    """回傳 (重寫後的問題, 使用的 token 數)"""
+    prompt = build_rewrite_prompt(user_query)
     try:
-        response = OpenAI_client.chat.completions.create(
+        response = get_openai_client().chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content.strip()
+        tokens = response.usage.total_tokens if response.usage else 0
+        return response.choices[0].message.content.strip(), tokens
     except Exception as e:
+        QA_ERRORS.labels(call="rewrite").inc()
         print(f"LLM重寫錯誤: {e}")
-        return user_query  
+        return user_query, 0
 
-def qa_pipeline(user_query, threshold=0.7):
-    
-    # 先嘗試直接搜尋
-    results = vector_search(user_query, limit=1, threshold=threshold)
-    if results:
-        matched_answer = results[0]['answer']
-    else:
-        # 信心不足 → 重寫問題再查
-        rewritten = llm_rewrite_query(user_query)
-        results = vector_search(rewritten, limit=1, threshold=threshold)
-        if not results:
-            return "抱歉，我無法找到相關的答案。"
-        matched_answer = results[0]['answer']
-    
-    # 用 LLM 生成人性化回覆
-    generate_prompt = f"""
+def discard_speculative_rewrite(future):
+    """直接命中時丟棄推測送出的重寫；還沒開始就取消，已送出的等完成後記錄浪費的 token"""
+    if future is None:
+        return
+    if future.cancel():
+        with speculative_lock:
+            speculative_stats["rewrites_cancelled"] += 1
+        return
+
+    def record_waste(f):
+        tokens = f.result()[1] if f.exception() is None else 0
+        with speculative_lock:
+            speculative_stats["rewrites_wasted"] += 1
+            speculative_stats["wasted_tokens"] += tokens
+    future.add_done_callback(record_waste)
+
+def get_speculative_stats():
+    with speculative_lock:
+        stats = dict(speculative_stats)
+    finished = stats["rewrites_wasted"]
+    stats["avg_wasted_tokens"] = stats["wasted_tokens"] / finished if finished else 0.0
+    return stats
+
+def build_generate_prompt(user_query, matched_answer):
+    return f"""
     使用者問題: {user_query}
     相關資訊: {matched_answer}
 
@@ -173,13 +328,121 @@ def qa_pipeline(user_query, threshold=0.7):
     4. 開頭一定要 "同學您好:"。
     5. 如果你有句號、驚嘆號，那就換行(\n\n)，如果你講完你要說的話(最後收尾後)就不用換行。
     """
-    try:
-        final_response = OpenAI_client.chat.completions.create(
+
+@timed(QA_STAGE_SECONDS, stage="generate")
+@traced("qa.generate")
+def generate_answer(user_query, matched_answer):
+    """呼叫 LLM 生成回答，QA_STREAMING 開啟時以串流方式接收並記錄 TTFT"""
+    generate_prompt = build_generate_prompt(user_query, matched_answer)
+    start = time.perf_counter()
+    ttft = None
+    if QA_STREAMING:
+        stream = get_openai_client().chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": generate_prompt}],
+            stream=True
+        )
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(delta)
+        answer = "".join(parts)
+    else:
+        final_response = get_openai_client().chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": generate_prompt}]
         )
-        return final_response.choices[0].message.content
+        answer = final_response.choices[0].message.content
+    record_generation_timing(ttft, time.perf_counter() - start)
+    return answer
+
+def record_generation_timing(ttft, total):
+    with generation_lock:
+        generation_timings.append((ttft, total))
+
+def get_generation_stats():
+    """最近 1000 次生成的 TTFT 與總時間（秒），用來調整 prompt 長度"""
+    with generation_lock:
+        timings = list(generation_timings)
+
+    def summarize(values):
+        if not values:
+            return {"count": 0}
+        values = sorted(values)
+        return {
+            "count": len(values),
+            "avg": sum(values) / len(values),
+            "p50": values[len(values) // 2],
+            "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        }
+
+    return {
+        "ttft": summarize([t for t, _ in timings if t is not None]),
+        "total": summarize([total for _, total in timings]),
+    }
+
+@timed(QA_STAGE_SECONDS, stage="total")
+@traced("qa.pipeline")
+def qa_pipeline(user_query, threshold=0.7):
+    
+    # 先查回答快取：完全相同的問題不必再算 embedding
+    cached = answer_cache.get_exact(user_query)
+    if cached is not None:
+        QA_ANSWERS.labels(source="exact_cache").inc()
+        return cached
+
+    # 推測式重寫：和 embedding + 直接搜尋同時進行
+    rewrite_future = None
+    if rewrite_executor is not None:
+        # ThreadPoolExecutor 不會複製 contextvars，在呼叫端的 context 中執行，qa.rewrite 才會掛在目前的 trace 下
+        rewrite_future = rewrite_executor.submit(contextvars.copy_context().run, llm_rewrite_query_with_usage, user_query)
+        with speculative_lock:
+            speculative_stats["speculative_rewrites"] += 1
+
+    query_embedding = embed_text(user_query)
+    if query_embedding is not None:
+        cached = answer_cache.get_similar(query_embedding)
+        if cached is not None:
+            discard_speculative_rewrite(rewrite_future)
+            answer_cache.put(user_query, cached, query_embedding)
+            QA_ANSWERS.labels(source="semantic_cache").inc()
+            return cached
+
+    # 先嘗試直接搜尋
+    results = vector_search(user_query, limit=1, threshold=threshold, query_embedding=query_embedding)
+    if results:
+        discard_speculative_rewrite(rewrite_future)
+        matched_answer = results[0]['answer']
+        source = "direct"
+    else:
+        # 信心不足 → 重寫問題再查
+        if rewrite_future is not None:
+            rewritten = rewrite_future.result()[0]
+            with speculative_lock:
+                speculative_stats["rewrites_used"] += 1
+        else:
+            rewritten = llm_rewrite_query(user_query)
+        results = vector_search(rewritten, limit=1, threshold=threshold)
+        if not results:
+            QA_ANSWERS.labels(source="not_found").inc()
+            return "抱歉，我無法找到相關的答案。"
+        matched_answer = results[0]['answer']
+        source = "rewrite"
+    
+    # 用 LLM 生成人性化回覆
+    try:
+        answer = generate_answer(user_query, matched_answer)
+        answer_cache.put(user_query, answer, query_embedding)
+        QA_ANSWERS.labels(source=source).inc()
+        return answer
     except Exception as e:
+        QA_ERRORS.labels(call="generate").inc()
+        QA_ANSWERS.labels(source="error").inc()
         print(f"LLM回答錯誤: {e}")
         return "抱歉，系統暫時無法處理您的問題，請稍後再試。"
 
@@ -0,0 +1,305 @@
+# QA_async.py
+# asyncio 版的 QA 流程：AsyncOpenAI + 非同步 MongoDB driver，共用連線池並以 semaphore 限制同時請求數
+# 背景執行一個 event loop，Flask handler 透過 qa_pipeline_sync 呼叫，不必改成 async
+import asyncio
+import os
+import threading
+import time
+
+from pymongo import AsyncMongoClient
+from pymongo.server_api import ServerApi
+
+import linebot_object.QA as QA
+import linebot_object.tracing as tracing
+from linebot_object.embedding_cache import get_embedding_cache, DEFAULT_MODEL
+
+MAX_CONCURRENT_EMBEDDINGS = int(os.getenv("QA_ASYNC_MAX_EMBEDDINGS", 64))
+MAX_CONCURRENT_SEARCHES = int(os.getenv("QA_ASYNC_MAX_SEARCHES", 64))
+MAX_CONCURRENT_LLM = int(os.getenv("QA_ASYNC_MAX_LLM", 32))
+
+loop = None
+loop_thread = None
+loop_lock = threading.Lock()
+
+async_openai_client = None
+async_mongo_client = None
+async_qa_collection = None
+embed_semaphore = None
+search_semaphore = None
+llm_semaphore = None
+
+
+def start_loop():
+    """啟動背景 event loop（只會啟動一次）"""
+    global loop, loop_thread
+    with loop_lock:
+        if loop is not None:
+            return loop
+        loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=loop.run_forever, name="qa-async-loop", daemon=True)
+        loop_thread.start()
+        asyncio.run_coroutine_threadsafe(_init_clients(), loop).result()
+        return loop
+
+
+async def _init_clients():
+    global async_openai_client, embed_semaphore, search_semaphore, llm_semaphore
+    if QA.QA_BACKEND == "fake":
+        from linebot_object.fake_backend import FakeAsyncOpenAIClient
+        async_openai_client = FakeAsyncOpenAIClient()
+    else:
+        from openai import AsyncOpenAI
+        async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    embed_semaphore = asyncio.Semaphore(MAX_CONCURRENT_EMBEDDINGS)
+    search_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
+    llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM)
+
+
+def init_async_qa(mongo_uri=None, db_name="GDG-QA", collection_name="qa_vectors", max_pool_size=100):
+    """建立共用的 AsyncOpenAI 與非同步 MongoDB 連線池；沒有 mongo_uri 時向量搜尋改用同步版本"""
+    start_loop()
+    # 重新連線時會再呼叫一次；已建立的非同步 client 會自己重新連線，不重複建立
+    if mongo_uri and async_mongo_client is None:
+        asyncio.run_coroutine_threadsafe(
+            _init_mongo(mongo_uri, db_name, collection_name, max_pool_size), loop
+        ).result()
+    print("非同步 QA 模組初始化完成")
+
+
+async def _init_mongo(mongo_uri, db_name, collection_name, max_pool_size):
+    global async_mongo_client, async_qa_collection
+    async_mongo_client = AsyncMongoClient(
+        mongo_uri,
+        server_api=ServerApi('1'),
+        # 與 main.py 的同步 client 使用相同的 TLS 設定
+        tls=True,
+        tlsAllowInvalidHostnames=True,
+        tlsAllowInvalidCertificates=True,
+        maxPoolSize=max_pool_size,
+        serverSelectionTimeoutMS=10000,
+        connectTimeoutMS=10000,
+        socketTimeoutMS=20000,
+    )
+    async_qa_collection = async_mongo_client[db_name][collection_name]
+
+
+async def embed_text(text):
+    """使用 OpenAI embedding 生成向量（與同步版共用 embedding 快取）"""
+    # 快取的 SQLite 讀寫會持有全域鎖並 commit，放到執行緒上，不阻塞 event loop 上其他的請求
+    cache = get_embedding_cache()
+    embedding = await asyncio.to_thread(cache.get, DEFAULT_MODEL, text)
+    if embedding is not None:
+        return embedding
+    try:
+        with QA.QA_STAGE_SECONDS.labels(stage="embed").time(), tracing.span("qa.embed"):
+            async with embed_semaphore:
+                response = await async_openai_client.embeddings.create(model=DEFAULT_MODEL, input=text)
+        embedding = response.data[0].embedding
+        await asyncio.to_thread(cache.put, DEFAULT_MODEL, text, embedding)
+        return embedding
+    except Exception as e:
+        QA.QA_ERRORS.labels(call="embed").inc()
+        print(f"生成向量錯誤: {e}")
+        return None
+
+
+async def vector_search(query, limit=3, threshold=0.7, query_embedding=None):
+    """向量搜尋，已經算好 query_embedding 時可直接傳入"""
+    if query_embedding is None:
+        query_embedding = await embed_text(query)
+    if query_embedding is None:
+        return []
+
+    if QA.QA_VECTOR_BACKEND == "local" and QA.local_index.is_loaded():
+        results = QA.local_index.search(query_embedding, limit=limit)
+        return [r for r in results if r.get('score', 0) >= threshold]
+
+    if async_qa_collection is None:
+        # 沒有非同步連線時改在 thread 中使用同步版本
+        return await asyncio.to_thread(QA.vector_search, query, limit, threshold, query_embedding)
+
+    try:
+        with QA.QA_STAGE_SECONDS.labels(stage="vector_search").time(), tracing.span("qa.vector_search"):
+            async with search_semaphore:
+                cursor = await async_qa_collection.aggregate(QA.build_vector_search_pipeline(query_embedding, limit))
+                results = await cursor.to_list(None)
+        return [r for r in results if r.get('score', 0) >= threshold]
+    except Exception as e:
+        QA.QA_ERRORS.labels(call="vector_search").inc()
+        print(f"向量搜尋錯誤: {e}")
+        return []
+
+
+async def llm_rewrite_query(user_query):
+    """LLM 幫忙重寫問題"""
+    return (await llm_rewrite_query_with_usage(user_query))[0]
+
+
+async def llm_rewrite_query_with_usage(user_query, sent=None):
+    """回傳 (重寫後的問題, 使用的 token 數)；sent 在請求送出時設定，推測式重寫以此判斷能否直接取消"""
+    try:
+        with QA.QA_STAGE_SECONDS.labels(stage="rewrite").time(), tracing.span("qa.rewrite"):
+            async with llm_semaphore:
+                if sent is not None:
+                    sent.set()
+                response = await async_openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[{"role": "user", "content": QA.build_rewrite_prompt(user_query)}]
+                )
+        tokens = response.usage.total_tokens if response.usage else 0
+        return response.choices[0].message.content.strip(), tokens
+    except Exception as e:
+        QA.QA_ERRORS.labels(call="rewrite").inc()
+        print(f"LLM重寫錯誤: {e}")
+        return user_query, 0
+
+
+def discard_speculative_rewrite(task, sent):
+    """與 QA.discard_speculative_rewrite 相同：請求還沒送出就取消，已送出的等完成後記錄浪費的 token"""
+    if task is None:
+        return
+    if not sent.is_set() and task.cancel():
+        with QA.speculative_lock:
+            QA.speculative_stats["rewrites_cancelled"] += 1
+        return
+
+    def record_waste(t):
+        tokens = t.result()[1] if not t.cancelled() and t.exception() is None else 0
+        with QA.speculative_lock:
+            QA.speculative_stats["rewrites_wasted"] += 1
+            QA.speculative_stats["wasted_tokens"] += tokens
+    task.add_done_callback(record_waste)
+
+
+async def generate_answer(user_query, matched_answer):
+    """呼叫 LLM 生成回答，QA_STREAMING 開啟時以串流方式接收並記錄 TTFT"""
+    messages = [{"role": "user", "content": QA.build_generate_prompt(user_query, matched_answer)}]
+    start = time.perf_counter()
+    with tracing.span("qa.generate"):
+        answer, ttft = await _generate(messages, start)
+    QA.record_generation_timing(ttft, time.perf_counter() - start)
+    QA.QA_STAGE_SECONDS.labels(stage="generate").observe(time.perf_counter() - start)
+    return answer
+
+
+async def _generate(messages, start):
+    ttft = None
+    async with llm_semaphore:
+        if QA.QA_STREAMING:
+            stream = await async_openai_client.chat.completions.create(
+                model="gpt-4o-mini", messages=messages, stream=True
+            )
+            parts = []
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    parts.append(delta)
+            answer = "".join(parts)
+        else:
+            final_response = await async_openai_client.chat.completions.create(
+                model="gpt-4o-mini", messages=messages
+            )
+            answer = final_response.choices[0].message.content
+    return answer, ttft
+
+
+async def qa_pipeline(user_query, threshold=0.7, parent_span=None):
+    # 背景 event loop 不會繼承呼叫端執行緒的 contextvars，由 qa_pipeline_sync 傳入目前的 span
+    with tracing.attach(parent_span or tracing.current_span()):
+        with QA.QA_STAGE_SECONDS.labels(stage="total").time(), tracing.span("qa.pipeline"):
+            return await _qa_pipeline(user_query, threshold)
+
+
+async def _qa_pipeline(user_query, threshold):
+    # 先查回答快取：完全相同的問題不必再算 embedding
+    cached = QA.answer_cache.get_exact(user_query)
+    if cached is not None:
+        QA.QA_ANSWERS.labels(source="exact_cache").inc()
+        return cached
+
+    # 推測式重寫：和 embedding + 直接搜尋同時進行
+    rewrite_task, rewrite_sent = None, asyncio.Event()
+    if QA.QA_SPECULATIVE_REWRITE:
+        rewrite_task = asyncio.create_task(llm_rewrite_query_with_usage(user_query, rewrite_sent))
+        with QA.speculative_lock:
+            QA.speculative_stats["speculative_rewrites"] += 1
+
+    query_embedding = await embed_text(user_query)
+    if query_embedding is not None:
+        cached = QA.answer_cache.get_similar(query_embedding)
+        if cached is not None:
+            discard_speculative_rewrite(rewrite_task, rewrite_sent)
+            QA.answer_cache.put(user_query, cached, query_embedding)
+            QA.QA_ANSWERS.labels(source="semantic_cache").inc()
+            return cached
+
+    # 先嘗試直接搜尋
+    results = await vector_search(user_query, limit=1, threshold=threshold, query_embedding=query_embedding)
+    if results:
+        discard_speculative_rewrite(rewrite_task, rewrite_sent)
+        matched_answer = results[0]['answer']
+        source = "direct"
+    else:
+        # 信心不足 → 重寫問題再查
+        if rewrite_task is not None:
+            rewritten = (await rewrite_task)[0]
+            with QA.speculative_lock:
+                QA.speculative_stats["rewrites_used"] += 1
+        else:
+            rewritten = await llm_rewrite_query(user_query)
+        results = await vector_search(rewritten, limit=1, threshold=threshold)
+        if not results:
+            QA.QA_ANSWERS.labels(source="not_found").inc()
+            return "抱歉，我無法找到相關的答案。"
+        matched_answer = results[0]['answer']
+        source = "rewrite"
+
+    # 用 LLM 生成人性化回覆
+    try:
+        answer = await generate_answer(user_query, matched_answer)
+        QA.answer_cache.put(user_query, answer, query_embedding)
+        QA.QA_ANSWERS.labels(source=source).inc()
+        return answer
+    except Exception as e:
+        QA.QA_ERRORS.labels(call="generate").inc()
+        QA.QA_ANSWERS.labels(source="error").inc()
+        print(f"LLM回答錯誤: {e}")
+        return "抱歉，系統暫時無法處理您的問題，請稍後再試。"
+
+
+def qa_pipeline_sync(user_query, threshold=0.7, timeout=60):
+    """同步介面：給目前的 Flask handler 使用，實際在背景 event loop 上執行"""
+    start_loop()
+    future = asyncio.run_coroutine_threadsafe(qa_pipeline(user_query, threshold, tracing.current_span()), loop)
+    try:
+        return future.result(timeout=timeout)
+    except Exception as e:
+        future.cancel()
+        print(f"非同步 QA 處理失敗: {e}")
+        return "抱歉，系統暫時無法處理您的問題，請稍後再試。"
+
+
+def shutdown():
+    """關閉連線池並停止背景 event loop"""
+    global loop
+    with loop_lock:
+        if loop is None:
+            return
+
+        async def _close():
+            if async_mongo_client is not None:
+                await async_mongo_client.close()
+            if async_openai_client is not None:
+                await async_openai_client.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(_close(), loop).result(timeout=5)
+        except Exception as e:
+            print(f"關閉非同步 QA 連線失敗: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(timeout=5)
+        loop = None
@@ -0,0 +1,119 @@
+# answer_cache.py
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text):
+    """正規化問題文字：全形轉半形、轉小寫、合併空白、去掉結尾標點"""
+    text = unicodedata.normalize("NFKC", text).lower().strip()
+    text = re.sub(r"\s+", " ", text)
+    return text.rstrip("?!.。？！～~ ")
+
+
+class AnswerCache:
+    """QA 回答快取
+
+    - 第一層：正規化後的問題文字完全相同
+    - 第二層：和快取中問題的 embedding cosine 相似度超過 similarity_threshold
+    """
+
+    def __init__(self, max_size=256, ttl=3600, similarity_threshold=0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()  # 正規化問題 -> (寫入時間, 回答, 單位向量或 None)
+        self.lock = threading.Lock()
+        # 第二層查詢用的矩陣，快取內容變動後才重建
+        self.matrix = None
+        self.matrix_keys = []
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "invalidations": 0}
+
+    def get_exact(self, query):
+        if self.max_size <= 0:
+            return None
+        key = normalize_query(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry):
+                return None
+            self.entries.move_to_end(key)
+            self.stats["exact_hits"] += 1
+            return entry[1]
+
+    def get_similar(self, embedding):
+        """用 embedding 找最接近的快取問題，沒有超過門檻時記為 miss"""
+        if self.max_size <= 0:
+            return None
+        with self.lock:
+            if self.matrix is None:
+                self._rebuild_matrix()
+            if not self.matrix_keys:
+                self.stats["misses"] += 1
+                return None
+
+            query = np.asarray(embedding, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            if norm == 0:
+                self.stats["misses"] += 1
+                return None
+            scores = self.matrix @ (query / norm)
+            best = int(np.argmax(scores))
+            entry = self.entries.get(self.matrix_keys[best])
+            if scores[best] < self.similarity_threshold or entry is None or self._expired(entry):
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(self.matrix_keys[best])
+            self.stats["semantic_hits"] += 1
+            return entry[1]
+
+    def put(self, query, answer, embedding=None):
+        if self.max_size <= 0:
+            return
+        unit = None
+        if embedding is not None:
+            unit = np.asarray(embedding, dtype=np.float32)
+            norm = np.linalg.norm(unit)
+            unit = unit / norm if norm else None
+
+        key = normalize_query(query)
+        with self.lock:
+            self.entries[key] = (time.time(), answer, unit)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def invalidate(self):
+        """知識庫（qa_vectors）更新後清空所有快取"""
+        with self.lock:
+            self.entries.clear()
+            self.matrix = None
+            self.matrix_keys = []
+            self.stats["invalidations"] += 1
+
+    def _expired(self, entry):
+        return time.time() - entry[0] > self.ttl
+
+    def _rebuild_matrix(self):
+        now = time.time()
+        # 順便清掉過期的項目
+        for key in [k for k, entry in self.entries.items() if now - entry[0] > self.ttl]:
+            del self.entries[key]
+        self.matrix_keys = [k for k, entry in self.entries.items() if entry[2] is not None]
+        if self.matrix_keys:
+            self.matrix = np.stack([self.entries[k][2] for k in self.matrix_keys])
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["semantic_hits"]) / lookups if lookups else 0.0
+        return stats
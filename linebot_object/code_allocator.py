@@ -0,0 +1,88 @@
+# code_allocator.py
+import threading
+
+from pymongo import ReturnDocument
+
+
+class SerialBlockAllocator:
+    """流水號區塊配發器
+
+    每次以一個原子 $inc 向 global_counter 預約 block_size 個流水號，之後在本機用 lock 依序發放，
+    多個 gunicorn worker / 多台機器各自預約不重疊的區間，流水號仍然全域唯一。
+    關閉時沒用完的區間會存回 serial_leftovers，下次預約時優先回收。
+    """
+
+    def __init__(self, collection_getter, block_size=100, counter_id="global_counter", leftover_id="serial_leftovers"):
+        # collection 可能在重新連線後被替換，因此每次預約時才取得
+        self.collection_getter = collection_getter
+        self.block_size = block_size
+        self.counter_id = counter_id
+        self.leftover_id = leftover_id
+        self.lock = threading.Lock()
+        self.next = 0
+        self.end = 0  # 不含 end
+        self.stats = {"blocks_leased": 0, "blocks_reclaimed": 0, "serials_issued": 0}
+
+    def next_serial(self):
+        with self.lock:
+            if self.next >= self.end:
+                self._lease_block()
+            serial = self.next
+            self.next += 1
+            self.stats["serials_issued"] += 1
+            return serial
+
+    def _lease_block(self):
+        collection = self.collection_getter()
+        if collection is None:
+            raise RuntimeError("資料庫尚未連線，無法預約流水號")
+
+        # 先回收其他 process 關閉時留下的區間
+        leftover = collection.find_one_and_update(
+            {"_id": self.leftover_id, "ranges.0": {"$exists": True}},
+            {"$pop": {"ranges": -1}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if leftover is not None:
+            self.next, self.end = leftover["ranges"][0]
+            self.stats["blocks_reclaimed"] += 1
+            print(f"回收流水號區間 [{self.next}, {self.end})")
+            return
+
+        result = collection.find_one_and_update(
+            {"_id": self.counter_id},
+            {"$inc": {"counter": self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.end = result["counter"] + 1
+        self.next = self.end - self.block_size
+        self.stats["blocks_leased"] += 1
+        print(f"預約流水號區間 [{self.next}, {self.end})")
+
+    def release(self):
+        """關閉時把沒用完的區間存回資料庫，失敗則記錄在 log 中"""
+        with self.lock:
+            if self.next >= self.end:
+                return
+            unused = [self.next, self.end]
+            self.next = self.end
+
+        try:
+            collection = self.collection_getter()
+            if collection is None:
+                raise RuntimeError("資料庫尚未連線")
+            collection.update_one(
+                {"_id": self.leftover_id},
+                {"$push": {"ranges": unused}},
+                upsert=True
+            )
+            print(f"未使用的流水號區間 [{unused[0]}, {unused[1]}) 已存回資料庫")
+        except Exception as e:
+            print(f"警告: 無法存回未使用的流水號區間 [{unused[0]}, {unused[1]}): {e}")
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["remaining_in_block"] = max(0, self.end - self.next)
+        return stats
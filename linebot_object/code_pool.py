@@ -0,0 +1,174 @@
+# code_pool.py
+import random
+import threading
+import time
+from collections import deque
+
+from pymongo import ReturnDocument
+
+# 代碼格式 XXXPYYYY（3 碼 16 進位 + P + 4 碼數字，例如 1BAP0001），共 4096 * 10000 種
+# 流水號代碼（使用者 hash 前 3 碼 + 流水號）與備案代碼（F + 16 進位）都不含 P，三種代碼不可能重複
+CODE_SPACE = 16 ** 3 * 10000
+POOL_MARKER = "P"
+
+
+def format_code(n):
+    return f"{n // 10000:03X}{POOL_MARKER}{n % 10000:04d}"
+
+
+def is_pool_code(code):
+    return len(code) == 8 and code[3] == POOL_MARKER
+
+
+def generate_code_pool(collection, count, block_size=100, exclude=()):
+    """離線產生打亂順序的代碼池，每 block_size 個代碼存成一個區塊文件
+
+    codes 欄位建立 unique index，任何代碼都不可能同時出現在兩個區塊中。
+    exclude 可傳入已發出的代碼，避免和舊資料重複。
+    """
+    collection.create_index("codes", unique=True)
+    collection.create_index("leased")
+
+    existing = collection.distinct("codes")
+    legacy = [code for code in existing if not is_pool_code(code)]
+    if legacy:
+        # 舊格式的代碼可能與流水號重複，應先刪除尚未租用的舊區塊再重新產生
+        print(f"警告: 代碼池中有 {len(legacy)} 個沒有 {POOL_MARKER} 標記的舊格式代碼，可能與流水號代碼重複")
+    exclude = set(exclude)
+    exclude.update(existing)
+    if count + len(exclude) > CODE_SPACE:
+        raise ValueError(f"代碼空間不足: 最多還能產生 {CODE_SPACE - len(exclude)} 個代碼")
+
+    # 多抽一些再濾掉已存在的代碼，sample 本身就是打亂過的順序
+    rng = random.SystemRandom()
+    candidates = (format_code(n) for n in rng.sample(range(CODE_SPACE), count + len(exclude)))
+    codes = [c for c in candidates if c not in exclude][:count]
+
+    last = collection.find_one(sort=[("_id", -1)])
+    next_block_id = last["_id"] + 1 if last is not None else 0
+
+    blocks = []
+    for i in range(0, len(codes), block_size):
+        blocks.append({
+            "_id": next_block_id,
+            "codes": codes[i:i + block_size],
+            "leased": False,
+            "created_at": time.time()
+        })
+        next_block_id += 1
+    if blocks:
+        collection.insert_many(blocks)
+    print(f"代碼池新增 {len(codes)} 個代碼，共 {len(blocks)} 個區塊")
+    return len(codes)
+
+
+class CodePool:
+    """代碼池用戶端：每次以一個原子操作租用一整個區塊，之後在本機以 O(1) 取出代碼
+
+    剩餘代碼低於 low_watermark 時在背景預先租用下一個區塊，讓取號不必等待網路。
+    關閉時沒用完的代碼會寫回原本的區塊並解除租用。
+    """
+
+    def __init__(self, collection_getter, low_watermark=20):
+        # collection 可能在重新連線後被替換，因此每次租用時才取得
+        self.collection_getter = collection_getter
+        self.low_watermark = low_watermark
+        self.buffer = deque()  # (block_id, code)
+        self.lock = threading.Lock()
+        self.lease_lock = threading.Lock()
+        self.prefetching = False
+        self.exhausted_at = None
+        self.exhausted_retry = 60  # 用完後隔多久再向資料庫確認是否有補充
+        self.stats = {"claimed": 0, "blocks_leased": 0, "prefetches": 0, "empty_claims": 0}
+
+    def claim(self):
+        """取出一個代碼，代碼池用完時回傳 None"""
+        while True:
+            with self.lock:
+                if self.buffer:
+                    _, code = self.buffer.popleft()
+                    self.stats["claimed"] += 1
+                    need_prefetch = (len(self.buffer) < self.low_watermark and not self.prefetching
+                                     and not self._recently_exhausted())
+                    if need_prefetch:
+                        self.prefetching = True
+                    break
+                if self._recently_exhausted():
+                    self.stats["empty_claims"] += 1
+                    return None
+            # 租用區塊需要一次網路 round-trip，不持有 self.lock（lease_lock 保證同時只有一個租用請求），
+            # 租到後回到迴圈取號；剛租到的區塊被其他執行緒取完時再租下一個
+            self._lease_block(only_if_empty=True)
+
+        if need_prefetch:
+            threading.Thread(target=self._prefetch, name="code-pool-prefetch", daemon=True).start()
+        return code
+
+    def _prefetch(self):
+        try:
+            with self.lock:
+                self.stats["prefetches"] += 1
+            self._lease_block()
+        except Exception as e:
+            print(f"代碼池預先租用失敗: {e}")
+        finally:
+            with self.lock:
+                self.prefetching = False
+
+    def _recently_exhausted(self):
+        return self.exhausted_at is not None and time.time() - self.exhausted_at < self.exhausted_retry
+
+    def _lease_block(self, only_if_empty=False):
+        with self.lease_lock:
+            # 等待期間背景預先租用可能已經補滿
+            with self.lock:
+                if only_if_empty and self.buffer:
+                    return
+            collection = self.collection_getter()
+            if collection is None:
+                raise RuntimeError("資料庫尚未連線，無法租用代碼區塊")
+            block = collection.find_one_and_update(
+                {"leased": False},
+                {"$set": {"leased": True, "leased_at": time.time()}},
+                return_document=ReturnDocument.AFTER
+            )
+            with self.lock:
+                if block is None:
+                    if self.exhausted_at is None:
+                        print("警告: 代碼池已用完")
+                    self.exhausted_at = time.time()
+                    return
+                self.exhausted_at = None
+                self.buffer.extend((block["_id"], code) for code in block["codes"])
+                self.stats["blocks_leased"] += 1
+
+    def release(self):
+        """把沒用完的代碼寫回原本的區塊，讓其他 process 可以再租用"""
+        with self.lock:
+            remaining = list(self.buffer)
+            self.buffer.clear()
+        if not remaining:
+            return
+
+        by_block = {}
+        for block_id, code in remaining:
+            by_block.setdefault(block_id, []).append(code)
+
+        try:
+            collection = self.collection_getter()
+            if collection is None:
+                raise RuntimeError("資料庫尚未連線")
+            for block_id, codes in by_block.items():
+                collection.update_one(
+                    {"_id": block_id},
+                    {"$set": {"codes": codes, "leased": False}}
+                )
+            print(f"{len(remaining)} 個未使用的代碼已存回代碼池")
+        except Exception as e:
+            print(f"警告: 無法存回未使用的代碼 {[code for _, code in remaining]}: {e}")
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["buffered"] = len(self.buffer)
+        return stats
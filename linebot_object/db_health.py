@@ -0,0 +1,115 @@
+# db_health.py
+import random
+import threading
+
+
+class ConnectionHealthManager:
+    """資料庫連線的斷路器（closed / open / half_open）
+
+    - closed: 正常運作，連續失敗 failure_threshold 次就跳到 open
+    - open: 所有操作立即失敗，不在請求執行緒等待；由唯一的背景執行緒以 jitter 退避重新連線
+    - half_open: 重新連線成功後，先放行少量請求試探，成功回到 closed，失敗再回到 open
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, connect_func, on_connect, failure_threshold=3, base_delay=0.5, max_delay=30.0,
+                 half_open_max_calls=1):
+        self.connect_func = connect_func      # 建立並 ping 新的 client，失敗時丟出例外
+        self.on_connect = on_connect          # 連線成功後更新呼叫端的 client / collection
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = self.CLOSED
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.half_open_calls = 0
+        self.reconnect_thread = None
+        self.stopped = threading.Event()
+        self.stats = {"trips": 0, "rejected": 0, "reconnect_attempts": 0, "reconnects": 0}
+
+    def allow_request(self):
+        """是否放行這次資料庫操作；open 時立即回傳 False"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and self.half_open_calls < self.half_open_max_calls:
+                self.half_open_calls += 1
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            if self.state == self.HALF_OPEN:
+                self.half_open_calls = max(0, self.half_open_calls - 1)
+                self.state = self.CLOSED
+                print("資料庫斷路器恢復為 closed")
+
+    def record_failure(self, error=None):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN:
+                self.half_open_calls = max(0, self.half_open_calls - 1)
+            elif self.state == self.CLOSED and self.consecutive_failures < self.failure_threshold:
+                return
+            elif self.state == self.OPEN:
+                return
+            self._trip(error)
+
+    def mark_down(self, error=None):
+        """啟動時就無法連線：直接進入 open 並開始背景重新連線"""
+        with self.lock:
+            if self.state != self.OPEN:
+                self._trip(error)
+
+    def _trip(self, error):
+        # 呼叫端需持有 self.lock
+        self.state = self.OPEN
+        self.half_open_calls = 0
+        self.stats["trips"] += 1
+        print(f"資料庫斷路器開啟，改由背景重新連線: {error}")
+        if self.reconnect_thread is None:
+            self.reconnect_thread = threading.Thread(target=self._reconnect_loop, name="db-reconnect", daemon=True)
+            self.reconnect_thread.start()
+
+    def _backoff(self, attempt):
+        # full jitter：在 [0, min(max_delay, base * 2^attempt)] 之間隨機，避免多個 process 同時重連
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _reconnect_loop(self):
+        attempt = 0
+        while not self.stopped.wait(self._backoff(attempt)):
+            with self.lock:
+                self.stats["reconnect_attempts"] += 1
+            try:
+                client = self.connect_func()
+                self.on_connect(client)
+            except Exception as e:
+                attempt += 1
+                print(f"資料庫重新連線失敗 (第 {attempt} 次): {e}")
+                continue
+            with self.lock:
+                self.stats["reconnects"] += 1
+                self.consecutive_failures = 0
+                self.state = self.HALF_OPEN
+                # 在 lock 內清掉，之後再次 trip 一定會啟動新的重連執行緒
+                self.reconnect_thread = None
+            print("資料庫重新連線成功，斷路器進入 half_open")
+            return
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["state"] = self.STATE_CODES[self.state]
+            stats["consecutive_failures"] = self.consecutive_failures
+        return stats
+
+    def stop(self):
+        self.stopped.set()
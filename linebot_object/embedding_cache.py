@@ -0,0 +1,157 @@
+# embedding_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MODEL = "text-embedding-3-small"
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """Embedding 快取：記憶體 LRU + SQLite 永久保存
+
+    以 (model, 文字 hash) 為 key，向量以 float32 存放，重新啟動或離線腳本都能直接重用。
+    """
+
+    def __init__(self, path="embedding_cache.sqlite3", max_memory=2048):
+        self.path = path
+        self.max_memory = max_memory
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self.conn = None
+        if path:
+            try:
+                self.conn = sqlite3.connect(path, check_same_thread=False)
+                # WAL 讓多個 process 可以同時讀寫
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT, dim INTEGER, vector BLOB)"
+                )
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"Embedding 快取檔案無法使用，只使用記憶體快取: {e}")
+                self.conn = None
+
+    def get(self, model, text):
+        return self.get_many(model, [text]).get(text)
+
+    def get_many(self, model, texts):
+        """回傳 {文字: 向量}，只包含有快取的文字"""
+        found = {}
+        missing = {}
+        with self.lock:
+            for text in texts:
+                key = cache_key(model, text)
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[text] = self.memory[key]
+                    self.stats["memory_hits"] += 1
+                else:
+                    missing[key] = text
+
+            if missing and self.conn is not None:
+                keys = list(missing)
+                # SQLite 單次查詢的參數數量有上限，分批查詢
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    rows = self.conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                        found[missing.pop(key)] = vector
+                        self._remember(key, vector)
+                        self.stats["disk_hits"] += 1
+
+            self.stats["misses"] += len(missing)
+        return found
+
+    def put(self, model, text, embedding):
+        self.put_many(model, {text: embedding})
+
+    def put_many(self, model, embeddings):
+        rows = []
+        with self.lock:
+            for text, embedding in embeddings.items():
+                key = cache_key(model, text)
+                vector = np.asarray(embedding, dtype=np.float32)
+                self._remember(key, vector.tolist())
+                rows.append((key, model, len(vector), vector.tobytes()))
+
+            if rows and self.conn is not None:
+                try:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, model, dim, vector) VALUES (?, ?, ?, ?)", rows
+                    )
+                    self.conn.commit()
+                except sqlite3.Error as e:
+                    print(f"Embedding 快取寫入失敗: {e}")
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_size"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """整個 process 共用的快取，路徑由 EMBEDDING_CACHE_PATH 設定（設為空字串則只用記憶體）"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = EmbeddingCache(
+                path=os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3"),
+                max_memory=int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", 2048))
+            )
+        return _shared_cache
+
+
+def embed_with_cache(client, text, model=DEFAULT_MODEL):
+    """先查快取，沒有才呼叫 OpenAI embedding API"""
+    cache = get_embedding_cache()
+    embedding = cache.get(model, text)
+    if embedding is None:
+        response = client.embeddings.create(model=model, input=text)
+        embedding = response.data[0].embedding
+        cache.put(model, text, embedding)
+    return embedding
+
+
+def embed_many_with_cache(client, texts, model=DEFAULT_MODEL, batch_size=100):
+    """批次版 embed_with_cache：快取沒有的文字每 batch_size 筆呼叫一次 API，回傳與 texts 同順序的向量"""
+    cache = get_embedding_cache()
+    found = cache.get_many(model, texts)
+    missing = list(dict.fromkeys(t for t in texts if t not in found))
+
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        response = client.embeddings.create(model=model, input=batch)
+        # API 回傳的 data 依 index 對應輸入順序
+        embeddings = {batch[item.index]: item.embedding for item in response.data}
+        cache.put_many(model, embeddings)
+        found.update(embeddings)
+
+    return [found[t] for t in texts]
@@ -0,0 +1,166 @@
+# event_worker.py
+import contextvars
+import queue
+import threading
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+
+
+def lane_index(key, num_lanes):
+    """把 user_id_hash 對應到固定的 lane，同一個使用者永遠落在同一條"""
+    return zlib.crc32(key.encode()) % num_lanes
+
+
+class ShardedEventDispatcher:
+    """背景事件分派器：/callback 只負責驗證簽章並把事件丟進佇列，由 worker 執行真正的處理
+
+    依 user_id_hash 分成 N 條序列化的 lane，每條 lane 只有一個 worker，
+    同一個使用者的事件依序處理，不同使用者則在不同 lane 上平行處理。
+    worker 處理時持有該使用者的分段鎖（locks），與其他處理同一個使用者的路徑互斥。
+    """
+
+    def __init__(self, handle_func, num_lanes=4, max_queue_size=1000, locks=None, put_timeout=1.0):
+        self.handle_func = handle_func
+        self.num_lanes = num_lanes
+        self.locks = locks if locks is not None else StripedLock()
+        self.put_timeout = put_timeout
+        lane_size = max(1, max_queue_size // num_lanes)
+        self.queues = [queue.Queue(maxsize=lane_size) for _ in range(num_lanes)]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.submit_lock = threading.Lock()   # 檢查容量到放入之間，其他 submit 不能佔走空位
+        self.stopped = False
+        # 背壓統計
+        self.stats = {
+            "submitted": 0,
+            "processed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "max_queue_depth": 0,
+        }
+
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._worker_loop, args=(q,), name=f"event-lane-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, key, event, keys=None):
+        """放入 key 對應的 lane，佇列滿時最多等待 put_timeout 秒
+
+        不可改在其他執行緒直接處理（會與 lane 中同一個使用者較早的事件亂序），
+        逾時或已停止時回傳 False，由呼叫端回應錯誤讓 LINE 重送。
+        keys 為這個項目涉及的所有使用者（一批事件時），預設只有 key。
+        """
+        return self.submit_all([(key, event, keys)])
+
+    def submit_all(self, items):
+        """一次放入多個 (key, event, keys)：所有 lane 都有足夠空位才全部放入，否則一個都不放
+
+        同一個 webhook 的事件必須全部放入或全部不放，回應 503 後 LINE 重送整個 body，
+        已放入的事件才不會被處理兩次。
+        """
+        need = {}
+        for key, _, _ in items:
+            index = lane_index(key, self.num_lanes)
+            need[index] = need.get(index, 0) + 1
+        deadline = time.time() + self.put_timeout
+        while not self.stopped:
+            with self.submit_lock:
+                # worker 只會取出，持有 submit_lock 時空位只增不減；超過 lane 容量的部分等 worker 取出（先等 lane 清空）
+                if all(self.queues[i].maxsize - self.queues[i].qsize() >= min(n, self.queues[i].maxsize)
+                       for i, n in need.items()):
+                    for key, event, keys in items:
+                        # 連同呼叫端的 contextvars（例如 trace）一起放入，worker 在相同 context 中處理
+                        self.queues[lane_index(key, self.num_lanes)].put(
+                            (event, keys if keys is not None else (key,), contextvars.copy_context()))
+                    break
+            if time.time() >= deadline:
+                with self.lock:
+                    self.stats["rejected"] += len(items)
+                return False
+            time.sleep(0.005)
+        else:
+            return False
+
+        with self.lock:
+            self.stats["submitted"] += len(items)
+            depth = max(self.queues[i].qsize() for i in need)
+            if depth > self.stats["max_queue_depth"]:
+                self.stats["max_queue_depth"] = depth
+        return True
+
+    def _worker_loop(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            event, keys, context = item
+            try:
+                with self.locks.hold(keys):
+                    context.run(self.handle_func, event)
+                with self.lock:
+                    self.stats["processed"] += 1
+            except Exception as e:
+                with self.lock:
+                    self.stats["failed"] += 1
+                print(f"背景事件處理失敗: {e}")
+            finally:
+                q.task_done()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        depths = [q.qsize() for q in self.queues]
+        stats["queue_depth"] = sum(depths)
+        stats["busiest_lane_depth"] = max(depths)
+        stats["lane_capacity"] = self.queues[0].maxsize
+        stats["lanes"] = self.num_lanes
+        return stats
+
+    def shutdown(self, timeout=10):
+        """停止接收新事件，等待每條 lane 中的事件處理完畢（graceful drain）"""
+        if self.stopped:
+            return
+        self.stopped = True
+        deadline = time.time() + timeout
+
+        # 每個 worker 收到一個 None 就結束，排在既有事件之後
+        for q in self.queues:
+            remaining = max(0, deadline - time.time())
+            try:
+                q.put(None, timeout=remaining)
+            except queue.Full:
+                pass
+
+        for t in self.threads:
+            t.join(timeout=max(0, deadline - time.time()))
+
+        left = sum(q.qsize() for q in self.queues)
+        if left:
+            print(f"警告: 關閉時仍有 {left} 個事件未處理")
+        print(f"事件分派器已關閉: {self.get_stats()}")
+
+
+class StripedLock:
+    """同步模式用的分段鎖，同一個使用者的事件不會被多個請求執行緒同時處理"""
+
+    def __init__(self, num_stripes=64):
+        self.locks = [threading.Lock() for _ in range(num_stripes)]
+
+    def get(self, key):
+        return self.locks[lane_index(key, len(self.locks))]
+
+    def get_many(self, keys):
+        """多個使用者的鎖（去重並依固定順序排列），依序取得可避免死結"""
+        indexes = sorted({lane_index(key, len(self.locks)) for key in keys})
+        return [self.locks[i] for i in indexes]
+
+    @contextmanager
+    def hold(self, keys):
+        """依固定順序取得多個使用者的鎖"""
+        with ExitStack() as stack:
+            for lock in self.get_many(keys):
+                stack.enter_context(lock)
+            yield
@@ -0,0 +1,471 @@
+# fake_backend.py
+# 離線壓測用的假後端：不需要 OpenAI 與 Atlas 就能跑完整的 QA 流程與 handle_message
+import asyncio
+import copy
+import hashlib
+import random
+import threading
+import time
+import types
+from collections import Counter
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+def fake_embedding(text, dim=EMBEDDING_DIM):
+    """以文字 hash 為種子產生固定的單位向量，相同文字永遠得到相同的 embedding"""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeLatency:
+    """模擬網路延遲與錯誤：延遲為常態分布（mean, std 秒），error_rate 為失敗機率"""
+
+    def __init__(self, mean=0.0, std=0.0, error_rate=0.0, seed=None):
+        self.mean = mean
+        self.std = std
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        with self.lock:
+            delay = max(0.0, self.rng.gauss(self.mean, self.std)) if self.mean or self.std else 0.0
+            failed = self.rng.random() < self.error_rate
+        return delay, failed
+
+    def wait(self):
+        delay, failed = self.sample()
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise FakeBackendError("模擬的 API 錯誤")
+
+    async def wait_async(self):
+        delay, failed = self.sample()
+        if delay:
+            await asyncio.sleep(delay)
+        if failed:
+            raise FakeBackendError("模擬的 API 錯誤")
+
+
+def _completion_text(messages, completions):
+    prompt = messages[-1]["content"]
+    # 重寫問題的 prompt 回傳「標籤 + 原先問題」的格式
+    if "請判斷這個問題最相關的 QA 標籤" in prompt:
+        question = prompt.split("使用者問題:", 1)[1].split("\n", 1)[0].strip()
+        return f"學習內容 + {question}"
+    index = int(hashlib.sha256(prompt.encode()).hexdigest(), 16) % len(completions)
+    return completions[index]
+
+
+def _completion_response(text, prompt):
+    usage = types.SimpleNamespace(prompt_tokens=len(prompt) // 2, completion_tokens=len(text) // 2)
+    usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+    return types.SimpleNamespace(
+        choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))],
+        usage=usage
+    )
+
+
+def _stream_chunks(text, size=8):
+    for i in range(0, len(text), size):
+        yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text[i:i + size]))])
+
+
+def _embedding_response(input, dim):
+    texts = [input] if isinstance(input, str) else list(input)
+    return types.SimpleNamespace(data=[
+        types.SimpleNamespace(embedding=fake_embedding(t, dim), index=i) for i, t in enumerate(texts)
+    ])
+
+
+DEFAULT_COMPLETIONS = [
+    "同學您好: 我們每週都有社課與專案討論，歡迎一起來參加！",
+    "同學您好: 不論是不是資工系都可以加入，我們很歡迎跨領域的夥伴！",
+    "同學您好: 今年會有 AI 與生產力工具的主題課程，敬請期待！",
+]
+
+
+class FakeOpenAIClient:
+    """與 OpenAI client 相同介面的假 client：embeddings.create / chat.completions.create（含 stream）"""
+
+    def __init__(self, embed_latency=None, chat_latency=None, completions=None, dim=EMBEDDING_DIM):
+        self.embed_latency = embed_latency or FakeLatency()
+        self.chat_latency = chat_latency or FakeLatency()
+        self.completions_text = completions or DEFAULT_COMPLETIONS
+        self.dim = dim
+        self.calls = Counter()
+        self.embeddings = types.SimpleNamespace(create=self._create_embedding)
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create_completion))
+
+    def _create_embedding(self, model, input, **kwargs):
+        self.calls["embeddings"] += 1
+        self.embed_latency.wait()
+        return _embedding_response(input, self.dim)
+
+    def _create_completion(self, model, messages, stream=False, **kwargs):
+        self.calls["chat"] += 1
+        self.chat_latency.wait()
+        text = _completion_text(messages, self.completions_text)
+        if stream:
+            return _stream_chunks(text)
+        return _completion_response(text, messages[-1]["content"])
+
+
+class FakeAsyncOpenAIClient(FakeOpenAIClient):
+    """AsyncOpenAI 版本，給 QA_async 使用"""
+
+    async def _create_embedding(self, model, input, **kwargs):
+        self.calls["embeddings"] += 1
+        await self.embed_latency.wait_async()
+        return _embedding_response(input, self.dim)
+
+    async def _create_completion(self, model, messages, stream=False, **kwargs):
+        self.calls["chat"] += 1
+        await self.chat_latency.wait_async()
+        text = _completion_text(messages, self.completions_text)
+        if stream:
+            async def agen():
+                for chunk in _stream_chunks(text):
+                    yield chunk
+            return agen()
+        return _completion_response(text, messages[-1]["content"])
+
+    async def close(self):
+        pass
+
+
+# ---- 記憶體版 MongoDB collection ----
+
+def _get_field(doc, path):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            if part not in value:
+                return None, False
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit():
+            if int(part) >= len(value):
+                return None, False
+            value = value[int(part)]
+        else:
+            return None, False
+    return value, True
+
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(doc, q) for q in condition):
+                return False
+            continue
+        value, exists = _get_field(doc, key)
+        if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+            for op, arg in condition.items():
+                if op == "$in" and not any(value == a or (a is None and not exists) for a in arg):
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+                if op == "$exists" and exists != bool(arg):
+                    return False
+        elif condition is None:
+            if exists and value is not None:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {k for k, v in projection.items() if v}
+    if include:
+        result = {k: copy.deepcopy(doc[k]) for k in include if k in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {k: copy.deepcopy(v) for k, v in doc.items() if k not in projection}
+
+
+def _apply_update(doc, update, inserting=False):
+    for key, value in update.get("$set", {}).items():
+        doc[key] = copy.deepcopy(value)
+    if inserting:
+        for key, value in update.get("$setOnInsert", {}).items():
+            doc[key] = copy.deepcopy(value)
+    for key, value in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + value
+    for key, value in update.get("$push", {}).items():
+        doc.setdefault(key, []).append(copy.deepcopy(value))
+    for key, value in update.get("$pop", {}).items():
+        if doc.get(key):
+            doc[key].pop(0 if value == -1 else -1)
+
+
+class InMemoryCollection:
+    """支援本專案用到的 pymongo collection 操作（含 $vectorSearch aggregate），並統計每種操作的次數"""
+
+    def __init__(self, name="collection"):
+        self.name = name
+        self.docs = {}
+        self.lock = threading.RLock()
+        self.op_counts = Counter()
+        self.next_id = 0
+        self.vectors = {}  # path -> (docs, 正規化矩陣)，寫入時清除
+
+    def _new_id(self):
+        self.next_id += 1
+        return f"{self.name}-{self.next_id}"
+
+    def _find_docs(self, query):
+        query = query or {}
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self.docs.get(query["_id"])
+            return [doc] if doc is not None and _matches(doc, query) else []
+        return [doc for doc in self.docs.values() if _matches(doc, query)]
+
+    def find(self, query=None, projection=None, sort=None, limit=0):
+        with self.lock:
+            self.op_counts["find"] += 1
+            docs = self._find_docs(query)
+            if sort:
+                for key, direction in reversed(sort):
+                    docs.sort(key=lambda d: _get_field(d, key)[0], reverse=direction < 0)
+            if limit:
+                docs = docs[:limit]
+            return [_project(doc, projection) for doc in docs]
+
+    def find_one(self, query=None, projection=None, sort=None):
+        with self.lock:
+            self.op_counts["find_one"] += 1
+            docs = self._find_docs(query)
+            if sort:
+                for key, direction in reversed(sort):
+                    docs.sort(key=lambda d: _get_field(d, key)[0], reverse=direction < 0)
+            return _project(docs[0], projection) if docs else None
+
+    def count_documents(self, query):
+        with self.lock:
+            self.op_counts["count_documents"] += 1
+            return len(self._find_docs(query))
+
+    def distinct(self, key, query=None):
+        with self.lock:
+            self.op_counts["distinct"] += 1
+            values = []
+            for doc in self._find_docs(query):
+                value, exists = _get_field(doc, key)
+                for v in (value if isinstance(value, list) else [value]):
+                    if exists and v not in values:
+                        values.append(v)
+            return values
+
+    def insert_one(self, document):
+        with self.lock:
+            self.op_counts["insert_one"] += 1
+            self._insert(document)
+            return types.SimpleNamespace(inserted_id=document["_id"])
+
+    def insert_many(self, documents, ordered=True):
+        with self.lock:
+            self.op_counts["insert_many"] += 1
+            for document in documents:
+                self._insert(document)
+            return types.SimpleNamespace(inserted_ids=[d["_id"] for d in documents])
+
+    def _insert(self, document):
+        self.vectors.clear()
+        if "_id" not in document:
+            document["_id"] = self._new_id()
+        if document["_id"] in self.docs:
+            raise FakeBackendError(f"duplicate key: {document['_id']}")
+        self.docs[document["_id"]] = copy.deepcopy(document)
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            self.op_counts["update_one"] += 1
+            return self._update_one(query, update, upsert)
+
+    def _update_one(self, query, update, upsert):
+        self.vectors.clear()
+        docs = self._find_docs(query)
+        if docs:
+            _apply_update(docs[0], update)
+            return types.SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            _apply_update(doc, update, inserting=True)
+            self._insert(doc)
+            return types.SimpleNamespace(matched_count=0, modified_count=0, upserted_id=doc["_id"])
+        return types.SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=False, **kwargs):
+        with self.lock:
+            self.op_counts["find_one_and_update"] += 1
+            self.vectors.clear()
+            docs = self._find_docs(query)
+            if docs:
+                before = copy.deepcopy(docs[0])
+                _apply_update(docs[0], update)
+                return copy.deepcopy(docs[0]) if return_document else before
+            if upsert:
+                result = self._update_one(query, update, upsert=True)
+                return copy.deepcopy(self.docs[result.upserted_id]) if return_document else None
+            return None
+
+    def delete_one(self, query):
+        with self.lock:
+            self.op_counts["delete_one"] += 1
+            self.vectors.clear()
+            docs = self._find_docs(query)
+            if docs:
+                del self.docs[docs[0]["_id"]]
+            return types.SimpleNamespace(deleted_count=len(docs[:1]))
+
+    def delete_many(self, query):
+        with self.lock:
+            self.op_counts["delete_many"] += 1
+            self.vectors.clear()
+            docs = self._find_docs(query)
+            for doc in docs:
+                del self.docs[doc["_id"]]
+            return types.SimpleNamespace(deleted_count=len(docs))
+
+    def bulk_write(self, requests, ordered=True):
+        """支援 InsertOne / UpdateOne / DeleteOne，整批只算一次操作"""
+        with self.lock:
+            self.op_counts["bulk_write"] += 1
+            self.vectors.clear()
+            counts = {"nInserted": 0, "nMatched": 0, "nUpserted": 0, "nRemoved": 0}
+            for request in requests:
+                kind = type(request).__name__
+                if kind == "InsertOne":
+                    self._insert(request._doc)
+                    counts["nInserted"] += 1
+                elif kind == "UpdateOne":
+                    result = self._update_one(request._filter, request._doc, request._upsert)
+                    counts["nMatched"] += result.matched_count
+                    counts["nUpserted"] += result.upserted_id is not None
+                elif kind == "DeleteOne":
+                    docs = self._find_docs(request._filter)
+                    if docs:
+                        del self.docs[docs[0]["_id"]]
+                        counts["nRemoved"] += 1
+                else:
+                    raise FakeBackendError(f"不支援的 bulk 操作: {kind}")
+            # 與 pymongo 的 BulkWriteResult 相同的欄位
+            return types.SimpleNamespace(
+                bulk_api_result=counts, inserted_count=counts["nInserted"], matched_count=counts["nMatched"],
+                upserted_count=counts["nUpserted"], deleted_count=counts["nRemoved"]
+            )
+
+    def _vector_matrix(self, path):
+        """把 path 欄位的向量整理成正規化矩陣，資料沒變動前重複使用"""
+        if path not in self.vectors:
+            docs = [doc for doc in self.docs.values() if doc.get(path)]
+            matrix = np.asarray([doc[path] for doc in docs], dtype=np.float32).reshape(len(docs), -1)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self.vectors[path] = (docs, matrix / norms)
+        return self.vectors[path]
+
+    def aggregate(self, pipeline):
+        """只支援 QA.vector_search 使用的 $vectorSearch + $project 形式"""
+        with self.lock:
+            self.op_counts["aggregate"] += 1
+            results = []
+            for stage in pipeline:
+                if "$vectorSearch" in stage:
+                    spec = stage["$vectorSearch"]
+                    docs, matrix = self._vector_matrix(spec["path"])
+                    if not docs:
+                        results = []
+                        continue
+                    query = np.asarray(spec["queryVector"], dtype=np.float32)
+                    query /= np.linalg.norm(query) or 1.0
+                    # 與 Atlas cosine 相同的分數換算: (1 + cos) / 2
+                    scores = (1.0 + matrix @ query) / 2.0
+                    top = np.argsort(-scores)[:spec["limit"]]
+                    results = [dict(docs[i], _score=float(scores[i])) for i in top]
+                elif "$project" in stage:
+                    projected = []
+                    for doc in results:
+                        item = {"_id": doc["_id"]}
+                        for key, value in stage["$project"].items():
+                            if isinstance(value, dict) and value.get("$meta") == "vectorSearchScore":
+                                item[key] = doc["_score"]
+                            elif value and key in doc:
+                                item[key] = copy.deepcopy(doc[key])
+                        projected.append(item)
+                    results = projected
+            return iter(results)
+
+    def create_index(self, keys, **kwargs):
+        self.op_counts["create_index"] += 1
+        return str(keys)
+
+    def drop(self):
+        with self.lock:
+            self.docs.clear()
+            self.vectors.clear()
+
+    def total_ops(self):
+        with self.lock:
+            return sum(count for op, count in self.op_counts.items() if op != "create_index")
+
+
+class InMemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = InMemoryCollection(name)
+            return self.collections[name]
+
+
+class InMemoryMongoClient:
+    """取代 MongoClient，admin.command('ping') 永遠成功"""
+
+    def __init__(self, *args, **kwargs):
+        self.databases = {}
+        self.lock = threading.Lock()
+        self.admin = types.SimpleNamespace(command=lambda *a, **k: {"ok": 1})
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.databases:
+                self.databases[name] = InMemoryDatabase(name)
+            return self.databases[name]
+
+    def close(self):
+        pass
+
+    def total_ops(self):
+        with self.lock:
+            databases = list(self.databases.values())
+        return sum(c.total_ops() for db in databases for c in list(db.collections.values()))
+
+
+def build_fake_knowledge_base(collection, num_labels=5, aliases_per_label=20):
+    """產生假的 QA 知識庫文件（embedding 由 fake_embedding 產生），回傳所有 alias 文字"""
+    texts = []
+    for i in range(num_labels):
+        label = f"標籤{i}"
+        answer = f"這是標籤{i}的說明"
+        for text in [label] + [f"{label} 的問題 {j}" for j in range(aliases_per_label)]:
+            collection.insert_one({"text": text, "label": label, "answer": answer, "embedding": fake_embedding(text)})
+            texts.append(text)
+    return texts
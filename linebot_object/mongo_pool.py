@@ -0,0 +1,224 @@
+# mongo_pool.py
+# MongoDB 連線池設定檔、連線池事件監聽（checkout 等待時間）與預熱
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+
+from linebot_object.metrics import Counter, Histogram
+
+# 連線池設定檔，MONGO_POOL_PROFILE 選擇；warm_size 為預熱的連線數，warm_interval 為定期預熱的秒數（0 只在啟動時預熱）
+POOL_PROFILES = {
+    # 原本寫死在 create_mongodb_client 的設定
+    "default": {
+        "maxPoolSize": 40,
+        "minPoolSize": 5,
+        "maxIdleTimeMS": 50000,
+        "waitQueueTimeoutMS": 10000,
+        "serverSelectionTimeoutMS": 10000,
+        "connectTimeoutMS": 10000,
+        "socketTimeoutMS": 20000,
+        "warm_size": 5,
+        "warm_interval": 0,
+    },
+    # 迎新 / 擺攤當天：大量使用者同時加好友，連線保持溫熱，等待過久就快速失敗交給斷路器與 outbox
+    "fair_day": {
+        "maxPoolSize": 100,
+        "minPoolSize": 20,
+        "maxIdleTimeMS": 600000,
+        "waitQueueTimeoutMS": 2000,
+        "serverSelectionTimeoutMS": 5000,
+        "connectTimeoutMS": 5000,
+        "socketTimeoutMS": 10000,
+        "warm_size": 40,
+        "warm_interval": 30,
+    },
+    # 平常沒有活動時：少量連線，閒置就關閉，減少 Atlas 連線數
+    "idle_season": {
+        "maxPoolSize": 10,
+        "minPoolSize": 0,
+        "maxIdleTimeMS": 30000,
+        "waitQueueTimeoutMS": 10000,
+        "serverSelectionTimeoutMS": 10000,
+        "connectTimeoutMS": 10000,
+        "socketTimeoutMS": 20000,
+        "warm_size": 1,
+        "warm_interval": 0,
+    },
+}
+
+# 可個別覆寫設定檔中的值（以實際量到的 checkout 等待時間調整）
+PROFILE_ENV_OVERRIDES = {
+    "maxPoolSize": "MONGO_MAX_POOL_SIZE",
+    "minPoolSize": "MONGO_MIN_POOL_SIZE",
+    "warm_size": "MONGO_POOL_WARM_SIZE",
+    "warm_interval": "MONGO_POOL_WARM_INTERVAL",
+}
+
+
+def get_pool_profile(name):
+    """回傳連線池設定檔（含環境變數覆寫），名稱不存在時使用 default"""
+    if name not in POOL_PROFILES:
+        print(f"未知的連線池設定檔 {name}，改用 default")
+        name = "default"
+    profile = dict(POOL_PROFILES[name])
+    for key, env in PROFILE_ENV_OVERRIDES.items():
+        value = os.getenv(env)
+        if value:
+            profile[key] = float(value) if key == "warm_interval" else int(value)
+    profile["name"] = name
+    return profile
+
+
+def client_options(profile):
+    """設定檔中要傳給 MongoClient 的參數"""
+    return {k: v for k, v in profile.items() if k not in ("name", "warm_size", "warm_interval")}
+
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    "linebot_db_pool_checkout_seconds",
+    "從 MongoDB 連線池取得連線的等待時間（秒，含建立新連線）",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+POOL_CHECKOUT_FAILURES = Counter(
+    "linebot_db_pool_checkout_failures_total", "無法從連線池取得連線的次數", ["reason"]
+)
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """pymongo 連線池事件監聽：記錄 checkout 等待時間與連線數
+
+    事件在取得連線的執行緒上同步觸發，只做計數與一次 histogram observe。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {"created": 0, "closed": 0, "checked_out": 0, "in_use": 0, "checkout_failures": 0,
+                      "pool_cleared": 0}
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def _checkout_duration(self, event):
+        # pymongo 4.7 之後事件本身帶有 duration，舊版以 checkout 開始的時間計算
+        duration = getattr(event, "duration", None)
+        if duration is None:
+            started = getattr(self.local, "started", None)
+            duration = time.perf_counter() - started if started is not None else 0.0
+        return duration
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count("pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count("closed")
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        POOL_CHECKOUT_SECONDS.observe(self._checkout_duration(event))
+        POOL_CHECKOUT_FAILURES.labels(reason=event.reason).inc()
+        self._count("checkout_failures")
+
+    def connection_checked_out(self, event):
+        POOL_CHECKOUT_SECONDS.observe(self._checkout_duration(event))
+        with self.lock:
+            self.stats["checked_out"] += 1
+            self.stats["in_use"] += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.stats["in_use"] = max(0, self.stats["in_use"] - 1)
+
+    def open_connections(self):
+        with self.lock:
+            return self.stats["created"] - self.stats["closed"]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["open"] = stats["created"] - stats["closed"]
+        return stats
+
+
+class PoolWarmer:
+    """把連線池預熱到 warm_size 條連線，避免閒置後的第一波請求在請求執行緒上做 TLS 握手
+
+    以 warm_size 個執行緒同時送出 ping，連線池不夠時會建立新連線；interval > 0 時由背景執行緒定期預熱，
+    閒置超過 maxIdleTimeMS 被關閉的連線，或重新連線後的新連線池，會在下一次預熱補回。
+    """
+
+    def __init__(self, client_getter, listener, warm_size, interval=0, is_available=lambda: True, max_rounds=5):
+        self.client_getter = client_getter
+        self.listener = listener
+        self.warm_size = warm_size
+        self.interval = interval
+        self.is_available = is_available
+        self.max_rounds = max_rounds
+        self.lock = threading.Lock()
+        self.stats = {"warm_runs": 0, "warm_failures": 0, "last_warm_seconds": 0.0}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def warm(self):
+        """預熱一次，回傳預熱後開啟的連線數"""
+        client = self.client_getter()
+        if client is None or self.warm_size <= 0:
+            return 0
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=self.warm_size, thread_name_prefix="pool-warm") as executor:
+                for _ in range(self.max_rounds):
+                    if self.listener.open_connections() >= self.warm_size:
+                        break
+                    list(executor.map(lambda _: client.admin.command("ping"), range(self.warm_size)))
+        except Exception as e:
+            with self.lock:
+                self.stats["warm_failures"] += 1
+            print(f"連線池預熱失敗: {e}")
+            return self.listener.open_connections()
+        with self.lock:
+            self.stats["warm_runs"] += 1
+            self.stats["last_warm_seconds"] = time.perf_counter() - start
+        return self.listener.open_connections()
+
+    def start(self):
+        """interval > 0 時啟動背景執行緒，每 interval 秒預熱一次"""
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._warm_loop, name="pool-warmer", daemon=True)
+        self.thread.start()
+
+    def _warm_loop(self):
+        while not self.stopped.wait(self.interval):
+            if self.is_available():
+                self.warm()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["warm_size"] = self.warm_size
+        return stats
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,356 @@
+# outbox.py
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def _apply_record(doc, record):
+    """把一筆尚未寫回的操作套用到使用者文件上，回傳套用後的文件（可能為 None）
+
+    資料庫讀不到文件時，改用記錄當下的完整狀態 snapshot（若有）。
+    """
+    if doc is None:
+        snapshot = record.get("snapshot")
+        return dict(snapshot) if snapshot is not None else None
+    op = record["op"]
+    if op == "update":
+        return {**doc, **record["set"]}
+    if op == "transition":
+        expected = record["expected_state"]
+        state = doc.get("current_state", 1)
+        if state == expected and not doc.get("finish_gameplay", False):
+            return {**doc, **record["set"]}
+    return doc
+
+
+def user_write_operation(record):
+    """把一筆使用者操作紀錄轉成 bulk_write 用的 UpdateOne（outbox 重播與 webhook 批次寫入共用）"""
+    op = record["op"]
+    if op == "insert":
+        doc = {k: v for k, v in record["snapshot"].items() if k != "_id"}
+        return UpdateOne({"_id": record["user_id_hash"]}, {"$setOnInsert": doc}, upsert=True)
+    if op == "update":
+        return UpdateOne({"_id": record["user_id_hash"]}, {"$set": record["set"]})
+    # transition：與 main.transition_user_state_db 相同的條件，重複重播時條件不成立而不會重複套用
+    expected = record["expected_state"]
+    state_filter = {"$in": [1, None]} if expected == 1 else expected
+    return UpdateOne(
+        {"_id": record["user_id_hash"], "current_state": state_filter, "finish_gameplay": {"$ne": True}},
+        {"$set": record["set"]}
+    )
+
+
+class Outbox:
+    """資料庫無法使用時的本機 outbox：append-only JSONL 日誌，資料庫恢復後由背景執行緒重播
+
+    - append 只把紀錄放進記憶體並排入寫入佇列，由寫入執行緒每 fsync_interval 秒批次 write + fsync
+    - 重播以 bulk_write 的 upsert / 條件式更新進行，重複重播不會改變結果
+    - 尚未重播的紀錄會疊加到 find_user 讀到的狀態上，使用者在資料庫中斷期間仍能繼續答題
+    - 每個 process（gunicorn worker）各自寫 f"{path}.{pid}"，以同名的 .lock 檔 flock 標示仍在使用；
+      啟動時與每次重播檢查前，接手已結束的 process 留下的日誌（lock 可以取得的日誌）
+    """
+
+    def __init__(self, path, db_getter, is_available=lambda: True, fsync_interval=0.05,
+                 replay_interval=5.0, batch_size=500):
+        self.base_path = path
+        self.path = f"{path}.{os.getpid()}"
+        self.db_getter = db_getter
+        self.is_available = is_available
+        self.fsync_interval = fsync_interval
+        self.replay_interval = replay_interval
+        self.batch_size = batch_size
+
+        self.lock = threading.Lock()       # 保護 records / by_user / unwritten
+        self.io_lock = threading.Lock()    # 檔案寫入與壓縮，取得順序: io_lock → lock
+        self.records = []                  # 尚未重播的紀錄，依 seq 排序
+        self.by_user = {}                  # user_id_hash -> 該使用者尚未重播的紀錄
+        self.unwritten = []                # 已 append 但尚未寫入檔案的 JSON 行
+        self.next_seq = 1
+        self.stats = {"appended": 0, "fsync_batches": 0, "replayed": 0, "replay_failures": 0, "dropped": 0,
+                      "code_conflicts": 0}
+
+        # process 結束前一直持有自己日誌的 lock，其他 process 才不會接手
+        self.lock_file = open(self.path + ".lock", "a")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self._load()
+        self._adopt_orphans()
+        self.stopped = threading.Event()
+        self.writer_thread = threading.Thread(target=self._writer_loop, name="outbox-writer", daemon=True)
+        self.replay_thread = threading.Thread(target=self._replay_loop, name="outbox-replay", daemon=True)
+        self.writer_thread.start()
+        self.replay_thread.start()
+
+    @staticmethod
+    def _read_journal(path):
+        """讀回日誌中的紀錄；最後一行可能因為當機只寫了一半，截斷到最後一個換行，之後的 append 才不會接在殘缺的行後面"""
+        with open(path, "rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                content = content[:content.rfind(b"\n") + 1]
+                f.seek(0)
+                f.truncate(len(content))
+        records = []
+        for line in content.decode("utf-8").splitlines():
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return records
+
+    def _load(self):
+        """啟動時讀回上次未重播完的紀錄（pid 與之前的 process 相同時）"""
+        if not os.path.exists(self.path):
+            return
+        for record in self._read_journal(self.path):
+            self._index(record)
+            self.next_seq = max(self.next_seq, record["seq"] + 1)
+        if self.records:
+            print(f"outbox 載入 {len(self.records)} 筆尚未寫回資料庫的紀錄")
+
+    def _journal_paths(self):
+        """同一個 OUTBOX_PATH 下所有 process 的日誌（含舊版不帶 pid 的日誌）"""
+        paths = [path for path in glob.glob(glob.escape(self.base_path) + ".*")
+                 if path[len(self.base_path) + 1:].isdigit()]
+        if os.path.exists(self.base_path):
+            paths.append(self.base_path)
+        return paths
+
+    def _adopt_orphans(self):
+        """接手已結束的 process（worker 重啟、當機）留下的日誌，併入自己的日誌後刪除"""
+        for path in self._journal_paths():
+            if path == self.path:
+                continue
+            with open(path + ".lock", "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue    # 該 process 仍在執行，日誌由它自己重播
+                if not os.path.exists(path):
+                    os.remove(path + ".lock")
+                    continue    # 已被其他 process 接手
+                records = self._read_journal(path)
+                with self.io_lock:
+                    with self.lock:
+                        for record in records:
+                            # seq 只在單一 process 內唯一，重新編號；依 ts 排回原本的先後順序
+                            self._index({**record, "seq": self.next_seq})
+                            self.next_seq += 1
+                        self.records.sort(key=lambda r: r["ts"])
+                        for user_records in self.by_user.values():
+                            user_records.sort(key=lambda r: r["ts"])
+                    # 先寫入自己的日誌再刪除原日誌，中途當機最多重複重播（重播不會重複套用）
+                    self._rewrite()
+                os.remove(path)
+                os.remove(path + ".lock")
+            if records:
+                print(f"outbox 接手 {os.path.basename(path)} 的 {len(records)} 筆紀錄")
+
+    def _index(self, record):
+        self.records.append(record)
+        if "user_id_hash" in record:
+            self.by_user.setdefault(record["user_id_hash"], []).append(record)
+
+    # ---- 寫入 ----
+
+    def append(self, op, **fields):
+        with self.lock:
+            record = {"seq": self.next_seq, "ts": time.time(), "op": op, **fields}
+            self.next_seq += 1
+            self._index(record)
+            self.unwritten.append(json.dumps(record, ensure_ascii=False))
+            self.stats["appended"] += 1
+        return record
+
+    def record_insert(self, user_data):
+        return self.append("insert", user_id_hash=user_data["_id"], snapshot=user_data)
+
+    def record_update(self, user_id_hash, update_data, snapshot=None):
+        return self.append("update", user_id_hash=user_id_hash, set=update_data, snapshot=snapshot)
+
+    def record_transition(self, user_id_hash, expected_state, update_data, snapshot=None):
+        return self.append("transition", user_id_hash=user_id_hash, expected_state=expected_state,
+                           set=update_data, snapshot=snapshot)
+
+    def record_fallback_code(self, user_id_hash, code):
+        return self.append("fallback_code", code=code, owner=user_id_hash)
+
+    def _writer_loop(self):
+        while not self.stopped.wait(self.fsync_interval):
+            self._flush_to_disk()
+        self._flush_to_disk()
+
+    def _flush_to_disk(self):
+        with self.io_lock:
+            with self.lock:
+                lines, self.unwritten = self.unwritten, []
+            if not lines:
+                return
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                with self.lock:
+                    self.stats["fsync_batches"] += 1
+            except OSError as e:
+                # 寫檔失敗時放回佇列，下一輪再試
+                with self.lock:
+                    self.unwritten = lines + self.unwritten
+                print(f"outbox 寫入失敗: {e}")
+
+    # ---- 讀取 ----
+
+    def overlay(self, user_id_hash, doc):
+        """把尚未寫回的操作疊加到資料庫（或快取）讀到的文件上"""
+        with self.lock:
+            pending = list(self.by_user.get(user_id_hash, ()))
+        for record in pending:
+            doc = _apply_record(doc, record)
+        return doc
+
+    def has_pending(self, user_id_hash):
+        with self.lock:
+            return user_id_hash in self.by_user
+
+    # ---- 重播 ----
+
+    def _replay_loop(self):
+        while not self.stopped.wait(self.replay_interval):
+            self._adopt_orphans()
+            if self.records and self.is_available():
+                self.replay()
+
+    def replay(self):
+        """把最舊的 batch_size 筆紀錄寫回資料庫，成功後從日誌移除；回傳寫回的筆數"""
+        db = self.db_getter()
+        if db is None:
+            return 0
+        with self.lock:
+            batch = self.records[:self.batch_size]
+        if not batch:
+            return 0
+
+        user_ops, code_ops, code_owners = [], [], {}
+        for record in batch:
+            if record["op"] == "fallback_code":
+                code_owners.setdefault(record["code"], set()).add(record["owner"])
+                code_ops.append(UpdateOne(
+                    {"_id": record["code"]},
+                    {"$setOnInsert": {"user_id_hash": record["owner"], "created_at": record["ts"]}},
+                    upsert=True
+                ))
+            else:
+                user_ops.append(user_write_operation(record))
+
+        done = len(batch)
+        try:
+            if code_ops:
+                try:
+                    db["fallback_codes"].bulk_write(code_ops, ordered=False)
+                except BulkWriteError as e:
+                    # 以 upsert 寫入，同一個代碼同時 upsert 可能發生重複 _id，代碼仍已存在，由下方的比對確認擁有者
+                    print(f"outbox 重播備案代碼時發生錯誤: {e.details.get('writeErrors', [])[:1]}")
+                self._check_code_owners(db, code_owners)
+            if user_ops:
+                # 同一個使用者的操作有先後順序，必須 ordered
+                db["users"].bulk_write(user_ops, ordered=True)
+        except BulkWriteError as e:
+            # ordered 模式在第一個錯誤停止：之前的已寫入，錯誤的那筆無法重播，丟棄以免卡住整個日誌
+            error = e.details["writeErrors"][0]
+            done = self._batch_index_of_user_op(batch, error["index"]) + 1
+            with self.lock:
+                self.stats["dropped"] += 1
+            print(f"outbox 重播時丟棄無法寫入的紀錄: {error.get('errmsg')}")
+        except Exception as e:
+            with self.lock:
+                self.stats["replay_failures"] += 1
+            print(f"outbox 重播失敗，稍後再試: {e}")
+            return 0
+
+        self._remove(batch[:done])
+        print(f"outbox 已寫回 {done} 筆紀錄，剩餘 {len(self.records)} 筆")
+        return done
+
+    def _check_code_owners(self, db, code_owners):
+        """備案代碼是隨機產生的，$setOnInsert 遇到相同代碼會保留第一個擁有者：
+        比對資料庫中的擁有者，不同時記錄到 fallback_code_conflicts，兌獎時由工作人員核對兩位使用者"""
+        stored = {doc["_id"]: doc.get("user_id_hash")
+                  for doc in db["fallback_codes"].find({"_id": {"$in": list(code_owners)}})}
+        for code, owners in code_owners.items():
+            for owner in owners:
+                if stored.get(code) in (None, owner):
+                    continue
+                db["fallback_code_conflicts"].update_one(
+                    {"_id": f"{code}:{owner}"},
+                    {"$setOnInsert": {"code": code, "user_id_hash": owner, "existing_owner": stored[code],
+                                      "created_at": time.time()}},
+                    upsert=True
+                )
+                with self.lock:
+                    self.stats["code_conflicts"] += 1
+                print(f"警告: 備案代碼 {code} 重複發給兩位使用者，已記錄到 fallback_code_conflicts")
+
+    @staticmethod
+    def _batch_index_of_user_op(batch, user_op_index):
+        seen = -1
+        for i, record in enumerate(batch):
+            if record["op"] != "fallback_code":
+                seen += 1
+                if seen == user_op_index:
+                    return i
+        return len(batch) - 1
+
+    def _remove(self, done):
+        """移除已寫回的紀錄並重寫日誌檔（只保留尚未寫回的紀錄）"""
+        done_seqs = {record["seq"] for record in done}
+        with self.io_lock:
+            with self.lock:
+                self.records = [r for r in self.records if r["seq"] not in done_seqs]
+                for user_id_hash in {r["user_id_hash"] for r in done if "user_id_hash" in r}:
+                    remaining = [r for r in self.by_user[user_id_hash] if r["seq"] not in done_seqs]
+                    if remaining:
+                        self.by_user[user_id_hash] = remaining
+                    else:
+                        del self.by_user[user_id_hash]
+                self.stats["replayed"] += len(done)
+            self._rewrite()
+
+    def _rewrite(self):
+        """以記憶體中尚未重播的紀錄重寫自己的日誌（呼叫端持有 io_lock）；尚未寫入的行也一併寫進新檔案"""
+        with self.lock:
+            lines = [json.dumps(r, ensure_ascii=False) for r in self.records]
+            self.unwritten = []
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            if lines:
+                f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self.records)
+            stats["unwritten"] = len(self.unwritten)
+        return stats
+
+    def stop(self, timeout=5):
+        """停止背景執行緒並把尚未寫入的紀錄寫入檔案（下次啟動時重播）"""
+        self.stopped.set()
+        self.writer_thread.join(timeout=timeout)
+        if self.records and self.is_available():
+            self.replay()
+        with self.io_lock:
+            if not self.records:
+                # 全部寫回，不留下空的日誌；還有紀錄時保留日誌，由下一個 process 接手
+                for path in (self.path, self.path + ".lock"):
+                    if os.path.exists(path):
+                        os.remove(path)
+        self.lock_file.close()
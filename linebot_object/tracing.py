@@ -0,0 +1,273 @@
+# tracing.py
+# 輕量的事件追蹤：callback 建立 trace，經 contextvars 傳到 handler、資料庫操作與 QA 各階段
+# 只有被抽樣的 trace 會建立 span；未抽樣時 span() 只做一次 contextvar 讀取
+import contextvars
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+import urllib.request
+from functools import wraps
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "jsonl").lower()  # jsonl 或 otlp
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+SERVICE_NAME = "gdg-welcome-linebot"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class _NoopSpan:
+    """未抽樣時使用，所有操作都不做事"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """一個 webhook 請求的所有 span；目前開啟的 span 都結束時輸出一段
+
+    非同步 lane 中的 span 可能在 callback 結束後才開始，會以相同 trace_id 另外輸出一段。
+    """
+
+    def __init__(self, exporter):
+        self.trace_id = secrets.token_hex(16)
+        self.exporter = exporter
+        self.spans = []
+        self.open_spans = 0
+        self.lock = threading.Lock()
+
+    def _opened(self):
+        with self.lock:
+            self.open_spans += 1
+
+    def _closed(self, span):
+        with self.lock:
+            self.spans.append(span)
+            self.open_spans -= 1
+            if self.open_spans > 0:
+                return
+            spans, self.spans = self.spans, []
+        if self.exporter is not None:
+            self.exporter.export(self.trace_id, spans)
+
+
+class Span:
+    def __init__(self, trace, name, parent=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start_ns = 0
+        self.end_ns = 0
+        self.token = None
+        trace._opened()
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self.token)
+        self.trace._closed(self)
+        return False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def start_trace(name, **attributes):
+    """建立新的 trace 與根 span，依 TRACE_SAMPLE_RATE 抽樣，未抽樣時回傳 NOOP_SPAN"""
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return NOOP_SPAN
+    return Span(Trace(get_exporter()), name, attributes=attributes)
+
+
+def span(name, **attributes):
+    """在目前的 span 底下建立子 span；沒有抽樣中的 trace 時回傳 NOOP_SPAN"""
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent=parent, attributes=attributes)
+
+
+def current_span():
+    return _current_span.get()
+
+
+class attach:
+    """把其他執行緒或 event loop 中取得的 span 設為目前的 parent"""
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.token = None
+
+    def __enter__(self):
+        self.token = _current_span.set(self.parent)
+        return self.parent
+
+    def __exit__(self, *exc):
+        _current_span.reset(self.token)
+        return False
+
+
+def traced(name):
+    """裝飾器：函數執行期間建立子 span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TraceExporter:
+    """背景執行緒批次輸出完成的 trace：jsonl 每行一段 trace，otlp 以 OTLP/HTTP JSON 送到 collector"""
+
+    def __init__(self, kind=TRACE_EXPORTER, path=TRACE_JSONL_PATH, endpoint=TRACE_OTLP_ENDPOINT,
+                 max_queue_size=10000, batch_size=100, flush_interval=1.0):
+        self.kind = kind
+        self.path = path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.stats = {"exported": 0, "dropped": 0, "export_failures": 0}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._export_loop, name="trace-exporter", daemon=True)
+        self.thread.start()
+
+    def export(self, trace_id, spans):
+        try:
+            self.queue.put_nowait((trace_id, spans))
+        except queue.Full:
+            # 寧可丟掉 trace 也不拖慢請求
+            with self.lock:
+                self.stats["dropped"] += 1
+
+    def _export_loop(self):
+        while True:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            batch.append(item)
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write(batch)
+                    return
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            if self.kind == "otlp":
+                self._post_otlp(batch)
+            else:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    for trace_id, spans in batch:
+                        spans = sorted((s.to_dict() for s in spans), key=lambda s: s["start_ns"])
+                        f.write(json.dumps({"trace_id": trace_id, "spans": spans}, ensure_ascii=False) + "\n")
+            with self.lock:
+                self.stats["exported"] += len(batch)
+        except Exception as e:
+            with self.lock:
+                self.stats["export_failures"] += 1
+            print(f"輸出 trace 失敗: {e}")
+
+    def _post_otlp(self, batch):
+        spans = []
+        for trace_id, trace_spans in batch:
+            for s in trace_spans:
+                spans.append({
+                    "traceId": trace_id,
+                    "spanId": s.span_id,
+                    "parentSpanId": s.parent_id or "",
+                    "name": s.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(s.start_ns),
+                    "endTimeUnixNano": str(s.end_ns),
+                    "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in s.attributes.items()],
+                    "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+                })
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "linebot_object.tracing"}, "spans": spans}],
+        }]}
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+        )
+        urllib.request.urlopen(request, timeout=5).close()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.queue.qsize()
+        return stats
+
+    def shutdown(self, timeout=5):
+        self.queue.put(None)
+        self.thread.join(timeout=timeout)
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = TraceExporter()
+    return _exporter
+
+
+def get_stats():
+    return _exporter.get_stats() if _exporter is not None else None
+
+
+def shutdown():
+    """關閉前把尚未輸出的 trace 寫完"""
+    if _exporter is not None:
+        _exporter.shutdown()
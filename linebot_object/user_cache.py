@@ -0,0 +1,159 @@
+# user_cache.py
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo import UpdateOne
+
+
+class UserStateCache:
+    """使用者狀態快取（LRU + TTL）
+
+    - write_through: 寫入同時更新資料庫與快取
+    - write_behind: 寫入只更新快取，由背景執行緒定期以 bulk_write 批次寫回資料庫
+    """
+
+    def __init__(self, collection_getter, max_size=5000, ttl=600, write_behind=False, flush_interval=1.0):
+        # collection 可能在重新連線後被替換，因此每次寫回時才取得
+        self.collection_getter = collection_getter
+        self.max_size = max_size
+        self.ttl = ttl
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+
+        self.entries = OrderedDict()  # user_id_hash -> (寫入時間, 文件)
+        self.pending = {}             # user_id_hash -> 尚未寫回的 $set 欄位
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "flushes": 0,
+            "flushed_ops": 0,
+            "flush_failures": 0,
+        }
+
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        if write_behind:
+            self.flush_thread = threading.Thread(target=self._flush_loop, name="user-cache-flush", daemon=True)
+            self.flush_thread.start()
+
+    def get(self, user_id_hash):
+        """取得快取中的文件副本，沒有或已過期時回傳 None"""
+        with self.lock:
+            entry = self.entries.get(user_id_hash)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            stored_at, doc = entry
+            if time.time() - stored_at > self.ttl:
+                del self.entries[user_id_hash]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(user_id_hash)
+            self.stats["hits"] += 1
+            return copy.deepcopy(doc)
+
+    def put(self, doc):
+        """放入從資料庫讀到的文件，並疊上尚未寫回的欄位，回傳最新的文件副本"""
+        user_id_hash = doc["_id"]
+        with self.lock:
+            doc = copy.deepcopy(doc)
+            doc.update(self.pending.get(user_id_hash, {}))
+            self._store(user_id_hash, doc)
+            return copy.deepcopy(doc)
+
+    def apply_update(self, user_id_hash, update_data):
+        """套用 $set 欄位到快取，write_behind 模式下同時排入待寫回清單"""
+        with self.lock:
+            self._apply(user_id_hash, update_data)
+
+    def compare_and_update(self, user_id_hash, expected_state, update_data):
+        """write_behind 模式下的條件式狀態轉移，語意與資料庫版本的 transition_user_state 相同"""
+        with self.lock:
+            entry = self.entries.get(user_id_hash)
+            if entry is None:
+                return None
+            doc = entry[1]
+            if doc.get("current_state", 1) != expected_state or doc.get("finish_gameplay", False):
+                return None
+            self._apply(user_id_hash, update_data)
+            return copy.deepcopy(self.entries[user_id_hash][1])
+
+    def invalidate(self, user_id_hash):
+        with self.lock:
+            self.entries.pop(user_id_hash, None)
+
+    def _apply(self, user_id_hash, update_data):
+        entry = self.entries.get(user_id_hash)
+        if entry is not None:
+            entry[1].update(copy.deepcopy(update_data))
+            self.entries.move_to_end(user_id_hash)
+        if self.write_behind:
+            self.pending.setdefault(user_id_hash, {}).update(copy.deepcopy(update_data))
+
+    def _store(self, user_id_hash, doc):
+        self.entries[user_id_hash] = (time.time(), doc)
+        self.entries.move_to_end(user_id_hash)
+        # 被淘汰的文件若還有待寫回欄位，仍保留在 pending 中，不會遺失
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def flush(self):
+        """把待寫回的欄位以一次 bulk_write 寫入資料庫，回傳寫入筆數"""
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                batch = self.pending
+                self.pending = {}
+
+            collection = self.collection_getter()
+            try:
+                if collection is None:
+                    raise RuntimeError("資料庫尚未連線")
+                requests = [UpdateOne({"_id": uid}, {"$set": data}) for uid, data in batch.items()]
+                collection.bulk_write(requests, ordered=False)
+            except Exception as e:
+                print(f"使用者狀態批次寫回失敗: {e}")
+                # 放回待寫回清單，期間的新寫入優先
+                with self.lock:
+                    for uid, data in batch.items():
+                        merged = dict(data)
+                        merged.update(self.pending.get(uid, {}))
+                        self.pending[uid] = merged
+                    self.stats["flush_failures"] += 1
+                return 0
+
+            with self.lock:
+                self.stats["flushes"] += 1
+                self.stats["flushed_ops"] += len(batch)
+            return len(batch)
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        """停止背景寫回並把剩餘的欄位寫入資料庫"""
+        self.stop_event.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join(timeout=5)
+        if self.write_behind:
+            self.flush()
+        print(f"使用者狀態快取已關閉: {self.get_stats()}")
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+            stats["pending_writes"] = len(self.pending)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
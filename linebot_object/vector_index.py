@@ -0,0 +1,77 @@
+# vector_index.py
+import threading
+import time
+
+import numpy as np
+
+
+class LocalVectorIndex:
+    """本機向量索引：把 qa_vectors 的 embedding 全部載入成一個 float32 矩陣
+
+    每列先做 L2 正規化，查詢只需要一次矩陣乘向量。
+    回傳格式與 Atlas $vectorSearch + $project 相同（text / label / answer / score），
+    score 依 Atlas cosine 相似度的定義換算為 (1 + cosine) / 2。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.matrix = None
+        self.docs = []
+        self.loaded_at = None
+
+    def load(self, collection):
+        """從 collection 重新載入，建立完成後才替換，查詢不會看到一半的資料"""
+        start = time.time()
+        docs = []
+        vectors = []
+        for doc in collection.find({}, {"text": 1, "label": 1, "answer": 1, "embedding": 1}):
+            embedding = doc.pop("embedding", None)
+            if not embedding:
+                continue
+            docs.append(doc)
+            vectors.append(embedding)
+
+        if vectors:
+            matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix /= norms
+        else:
+            matrix = None
+
+        with self.lock:
+            self.matrix = matrix
+            self.docs = docs
+            self.loaded_at = time.time()
+        print(f"本機向量索引載入 {len(docs)} 筆 ({time.time() - start:.2f} 秒)")
+        return len(docs)
+
+    def is_loaded(self):
+        return self.loaded_at is not None
+
+    def search(self, query_embedding, limit=3):
+        with self.lock:
+            matrix = self.matrix
+            docs = self.docs
+        if matrix is None:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        cosine = matrix @ (query / norm)
+
+        limit = min(limit, len(docs))
+        if limit < len(docs):
+            top = np.argpartition(-cosine, limit - 1)[:limit]
+        else:
+            top = np.arange(len(docs))
+        top = top[np.argsort(-cosine[top])]
+
+        results = []
+        for i in top:
+            result = dict(docs[i])
+            result["score"] = float((1.0 + cosine[i]) / 2.0)
+            results.append(result)
+        return results
@@ -0,0 +1,108 @@
+# webhook_batch.py
+# 同一個 webhook 內多個事件的批次處理：先以一次 $in 查詢讀回所有使用者，事件處理期間的寫入記在記憶體，
+# 全部處理完再以一次 bulk_write 寫回，每個 webhook 的資料庫 round-trip 數固定，不隨事件數增加
+import contextvars
+from contextlib import contextmanager
+
+from linebot_object.outbox import user_write_operation
+
+_current_batch = contextvars.ContextVar("webhook_batch", default=None)
+
+
+def current_batch():
+    """目前執行緒（或 lane）正在處理的批次，沒有時回傳 None"""
+    return _current_batch.get()
+
+
+class WebhookBatch:
+    """一個 webhook 的使用者狀態與尚未寫回的操作
+
+    寫入的語意與 main.insert_user / update_user / transition_user_state 相同，
+    操作紀錄的格式與 outbox 相同，寫回失敗時可直接交給 outbox。
+    """
+
+    def __init__(self, docs):
+        self.docs = dict(docs)   # user_id_hash -> 文件（資料庫中不存在則為 None）
+        self.records = []        # 依序記錄的操作，{"op", "user_id_hash", "set", "expected_state", "snapshot"}
+        self.changed = set()
+        self.conflicts = set()   # 寫回時條件式轉移不成立、已改以逐筆處理的使用者，快取不能放入批次的結果
+
+    def __contains__(self, user_id_hash):
+        return user_id_hash in self.docs
+
+    def get(self, user_id_hash):
+        doc = self.docs.get(user_id_hash)
+        return dict(doc) if doc is not None else None
+
+    def insert(self, user_data):
+        user_id_hash = user_data["_id"]
+        if self.docs.get(user_id_hash) is not None:
+            # 與 insert_one 的重複 _id 相同，不覆蓋既有的使用者
+            return False
+        self.docs[user_id_hash] = dict(user_data)
+        self._record("insert", user_id_hash, snapshot=dict(user_data))
+        return True
+
+    def update(self, user_id_hash, update_data):
+        doc = self.docs.get(user_id_hash)
+        if doc is not None:
+            doc.update(update_data)
+        self._record("update", user_id_hash, set=dict(update_data), snapshot=self.get(user_id_hash))
+        return True
+
+    def transition(self, user_id_hash, expected_state, update_data):
+        """條件式狀態轉移，條件不成立時回傳 None"""
+        doc = self.docs.get(user_id_hash)
+        if doc is None or doc.get("current_state", 1) != expected_state or doc.get("finish_gameplay", False):
+            return None
+        doc.update(update_data)
+        self._record("transition", user_id_hash, expected_state=expected_state, set=dict(update_data),
+                     snapshot=dict(doc))
+        return dict(doc)
+
+    def _record(self, op, user_id_hash, **fields):
+        self.records.append({"op": op, "user_id_hash": user_id_hash, **fields})
+        self.changed.add(user_id_hash)
+
+    def requests(self):
+        """寫回資料庫用的 bulk_write 操作，同一個使用者的操作有先後順序，需以 ordered 執行"""
+        return [user_write_operation(record) for record in self.records]
+
+    def expected_matches(self):
+        """全部寫入成功時 bulk_write 的 matched_count + upserted_count
+
+        insert 一定 matched 或 upserted；update 只有在使用者存在時才會 matched。
+        """
+        return sum(0 if record["op"] == "update" and record["snapshot"] is None else 1 for record in self.records)
+
+    def take_records(self, user_id_hashes):
+        """取出（並從批次中移除）這些使用者的操作紀錄，保持原本的順序"""
+        taken = [record for record in self.records if record["user_id_hash"] in user_id_hashes]
+        self.records = [record for record in self.records if record["user_id_hash"] not in user_id_hashes]
+        return taken
+
+    def assume(self, user_id_hash, fields):
+        """已直接寫入資料庫的欄位：只更新批次中的狀態，不產生操作紀錄"""
+        doc = self.docs.get(user_id_hash)
+        if doc is not None:
+            doc.update(fields)
+
+    def changed_docs(self):
+        return {user_id_hash: self.get(user_id_hash) for user_id_hash in self.changed}
+
+    @contextmanager
+    def activate(self):
+        token = _current_batch.set(self)
+        try:
+            yield self
+        finally:
+            _current_batch.reset(token)
+
+    @contextmanager
+    def suspend(self):
+        """暫時離開批次，期間的讀寫與逐筆處理相同，直接經過快取與資料庫"""
+        token = _current_batch.set(None)
+        try:
+            yield self
+        finally:
+            _current_batch.reset(token)
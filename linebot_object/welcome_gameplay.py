@@ -1,6 +1,8 @@
 import os
 import hashlib
 import time
+import json
+from functools import lru_cache
 
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
@@ -47,8 +49,30 @@ IMAGE_URLS = {
 }
 
 
-# 專屬題目的Message程式碼 
+class PreparedFlexMessage(FlexSendMessage):
+    """預先序列化好的 Flex 訊息，as_json_dict 直接回傳快取的內容，送出時不必再走訪整棵物件樹"""
+
+    def __init__(self, json_dict):
+        self.type = "flex"
+        self.alt_text = json_dict["altText"]
+        self.contents = json_dict["contents"]
+        self.quick_reply = None
+        self._json_dict = json_dict
+
+    def as_json_dict(self):
+        return self._json_dict
+
+
+def prepare_flex_message(message):
+    return PreparedFlexMessage(message.as_json_dict())
+
+
+# 專屬題目的Message程式碼（每一題只在啟動時建立一次）
 def build_question_message(current):
+    return QUESTION_TEMPLATES[current]
+
+
+def _build_question_message(current):
     question_text = QUESTIONS[current]
     image_url = IMAGE_URLS.get(current)
     options = ANSWER_OPTIONS[current]
@@ -88,8 +112,15 @@ def build_question_message(current):
     )
 
 
-# 使用者填完題目後的獎勵Message
+# 使用者填完題目後的獎勵Message：代入預先序列化好的骨架
+AWARD_CODE_PLACEHOLDER = "__UNIQUE_CODE__"
+
 def build_award_code_flex(unique_code):
+    rendered = AWARD_CODE_SKELETON.replace(json.dumps(AWARD_CODE_PLACEHOLDER), json.dumps(unique_code))
+    return PreparedFlexMessage(json.loads(rendered))
+
+
+def _build_award_code_flex(unique_code):
     return FlexSendMessage(
         alt_text="恭喜完成所有題目！您的專屬獎獎代碼",
         contents={
@@ -108,7 +139,13 @@ def build_award_code_flex(unique_code):
     )
     
 
+# 固定的回覆訊息參數都是常數，相同參數只建立一次
+@lru_cache(maxsize=64)
 def build_reply_flex(alt, title, desc, btn_label, btn_text, color):
+    return prepare_flex_message(_build_reply_flex(alt, title, desc, btn_label, btn_text, color))
+
+
+def _build_reply_flex(alt, title, desc, btn_label, btn_text, color):
     flex_content = {
         "type": "bubble",
         "body": {
@@ -132,4 +169,9 @@ def get_question_type(question_number):
     return QUESTION_TYPE.get(question_number)
 
 def get_answer_options(question_number):
-    return ANSWER_OPTIONS.get(question_number)
\ No newline at end of file
+    return ANSWER_OPTIONS.get(question_number)
+
+
+# 啟動時建立所有固定的訊息模板
+QUESTION_TEMPLATES = {current: prepare_flex_message(_build_question_message(current)) for current in QUESTIONS}
+AWARD_CODE_SKELETON = json.dumps(_build_award_code_flex(AWARD_CODE_PLACEHOLDER).as_json_dict(), ensure_ascii=False)
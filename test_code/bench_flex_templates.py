@@ -0,0 +1,43 @@
+import os
+import sys
+import json
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import linebot_object.welcome_gameplay as gameplay
+
+ROUNDS = 2000
+
+
+def serialize(messages):
+    """模擬 reply_message 送出前的序列化"""
+    return json.dumps({"replyToken": "x", "messages": [m.as_json_dict() for m in messages]})
+
+
+def bench(name, build_messages):
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        serialize(build_messages(i))
+    elapsed = (time.perf_counter() - start) / ROUNDS * 1e6
+    print(f"{name:<24} {elapsed:8.1f} µs / event")
+    return elapsed
+
+
+def events(question, award, reply):
+    """每個事件各建立一次題目、獎勵代碼與固定回覆訊息"""
+    return lambda i: [
+        question(i % 5 + 1),
+        award(f"ABC{i:04d}"),
+        reply("歡迎加入 GDG on Campus", "歡迎加入互動帳號！",
+              "我們是由 Google 官方支持成立、立足北大的開發者社群",
+              "想知道我們的日常", "那我們都在幹什麼", "#4385F3"),
+    ]
+
+
+if __name__ == "__main__":
+    print(f"=== Flex 訊息建立 + 序列化 ({ROUNDS} 次) ===")
+    before = bench("每次重新建立 (before)", events(
+        gameplay._build_question_message, gameplay._build_award_code_flex, gameplay._build_reply_flex))
+    after = bench("預先建立模板 (after)", events(
+        gameplay.build_question_message, gameplay.build_award_code_flex, gameplay.build_reply_flex))
+    print(f"加速 {before / after:.1f} 倍")
@@ -0,0 +1,79 @@
+# bench_qa_pipeline.py
+# 離線壓測 QA.qa_pipeline：使用 fake_backend 的假 OpenAI client 與記憶體 collection，不需要網路
+# 用法: python test_code/bench_qa_pipeline.py --questions 5000 --concurrency 32 --latency 0.02 --error-rate 0.01
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["QA_BACKEND"] = "fake"
+os.environ["EMBEDDING_CACHE_PATH"] = ""
+
+import linebot_object.QA as QA
+from linebot_object.fake_backend import (
+    FakeOpenAIClient, FakeLatency, InMemoryCollection, build_fake_knowledge_base
+)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def build_questions(texts, count, unique_ratio, seed):
+    """unique_ratio 比例的問題是新問題（不在知識庫內），其餘重複知識庫的文字，用來觀察快取命中"""
+    rng = random.Random(seed)
+    questions = []
+    for i in range(count):
+        if rng.random() < unique_ratio:
+            questions.append(f"隨機問題 {i}")
+        else:
+            questions.append(rng.choice(texts))
+    return questions
+
+
+def run(args):
+    client = FakeOpenAIClient(
+        embed_latency=FakeLatency(args.latency / 4, args.latency / 20, args.error_rate, seed=1),
+        chat_latency=FakeLatency(args.latency, args.latency / 5, args.error_rate, seed=2),
+    )
+    collection = InMemoryCollection("qa_vectors")
+    texts = build_fake_knowledge_base(collection, num_labels=args.labels, aliases_per_label=args.aliases)
+    QA.set_backend(openai_client=client, collection=collection)
+    questions = build_questions(texts, args.questions, args.unique_ratio, seed=3)
+
+    def ask(question):
+        start = time.perf_counter()
+        answer = QA.qa_pipeline(question)
+        return time.perf_counter() - start, answer
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(ask, questions))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    failures = sum(1 for _, answer in results if answer.startswith("抱歉"))
+    print(f"知識庫: {len(texts)} 筆, 問題: {len(questions)} 題, 並行數: {args.concurrency}")
+    print(f"總時間: {elapsed:.2f} 秒, 吞吐量: {len(questions) / elapsed:.0f} 題/秒")
+    print(f"延遲 p50: {percentile(latencies, 0.5) * 1000:.2f} ms, "
+          f"p95: {percentile(latencies, 0.95) * 1000:.2f} ms, "
+          f"p99: {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"無法回答/錯誤: {failures} 題")
+    print(f"API 呼叫次數: {dict(client.calls)}")
+    print(f"collection 操作: {dict(collection.op_counts)}")
+    print(f"回答快取: {QA.answer_cache.get_stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="離線壓測 QA pipeline")
+    parser.add_argument("--questions", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.0, help="模擬 LLM 延遲（秒），embedding 為其 1/4")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--labels", type=int, default=5)
+    parser.add_argument("--aliases", type=int, default=20)
+    parser.add_argument("--unique-ratio", type=float, default=0.5)
+    run(parser.parse_args())
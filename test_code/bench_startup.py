@@ -0,0 +1,103 @@
+# bench_startup.py
+# 啟動時間壓測：在子 process 中 import main，量測 import 時間、第一個 /callback 的延遲、/readyz 回 200 的時間
+# 用法: python test_code/bench_startup.py --runs 5 [--connect-delay 2.0] [--qa-backend openai]
+# --connect-delay 讓記憶體資料庫的建立多等幾秒，模擬連線 Atlas（DNS、TLS、ping）的時間
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_webhook import CHANNEL_SECRET, FakeLineBotApi, build_body, build_event, sign
+
+
+def child(args):
+    """在子 process 中執行一次冷啟動，結果以一行 JSON 輸出"""
+    if args.connect_delay > 0:
+        from linebot_object import fake_backend
+        original_init = fake_backend.InMemoryMongoClient.__init__
+
+        def slow_init(self, *a, **kw):
+            time.sleep(args.connect_delay)
+            original_init(self, *a, **kw)
+        fake_backend.InMemoryMongoClient.__init__ = slow_init
+
+    start = time.perf_counter()
+    import main
+    imported = time.perf_counter() - start
+
+    main.line_bot_api = main.line_bot_api_admin = FakeLineBotApi()
+    app = main.app.test_client()
+
+    health_status = app.get("/healthz").status_code
+    body = build_body([build_event("Ustartup0001", 0)])
+    request_start = time.perf_counter()
+    response = app.post("/callback", data=body, headers={"X-Line-Signature": sign(body)})
+    first_request = time.perf_counter() - request_start
+
+    while app.get("/readyz").status_code != 200:
+        if time.perf_counter() - start > args.timeout:
+            break
+        time.sleep(0.01)
+    ready = time.perf_counter() - start
+
+    print(json.dumps({
+        "import": imported,
+        "first_request": first_request,
+        "ready": ready,
+        "healthz": health_status,
+        "callback": response.status_code,
+    }))
+
+
+def run_once(lazy, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({
+            "CHANNEL_TOKEN_TEST": "bench",
+            "CHANNEL_SECRET_TEST": CHANNEL_SECRET,
+            "CHANNEL_ACCESS_TOKEN_ADMIN": "bench",
+            "ADMIN_ID": "Ubench-admin",
+            "OPENAI_API_KEY": env.get("OPENAI_API_KEY", "sk-bench"),
+            "DB_BACKEND": "memory",
+            "QA_BACKEND": args.qa_backend,
+            "EMBEDDING_CACHE_PATH": "",
+            "OUTBOX_PATH": os.path.join(tmp, "outbox.jsonl"),
+            "LAZY_STARTUP": "true" if lazy else "false",
+        })
+        command = [sys.executable, os.path.abspath(__file__), "--child",
+                   "--connect-delay", str(args.connect_delay), "--timeout", str(args.timeout)]
+        output = subprocess.run(command, env=env, capture_output=True, text=True, cwd=tmp)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def run(args):
+    for lazy in (False, True):
+        results = [run_once(lazy, args) for _ in range(args.runs)]
+        mode = "LAZY_STARTUP=true " if lazy else "LAZY_STARTUP=false"
+        median = {key: statistics.median(r[key] for r in results) for key in ("import", "first_request", "ready")}
+        statuses = {r["healthz"] for r in results} | {r["callback"] for r in results}
+        print(f"{mode}: import {median['import'] * 1000:7.1f} ms | "
+              f"第一個 /callback {median['first_request'] * 1000:7.1f} ms | "
+              f"/readyz 就緒 {median['ready'] * 1000:7.1f} ms | 狀態碼 {sorted(statuses)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="main.py 啟動時間壓測")
+    parser.add_argument("--runs", type=int, default=5, help="每種模式的冷啟動次數（取中位數）")
+    parser.add_argument("--connect-delay", type=float, default=0.0, help="模擬資料庫連線花費的秒數")
+    parser.add_argument("--qa-backend", default="openai", help="openai（量測 import openai 的成本）或 fake")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+    else:
+        run(args)
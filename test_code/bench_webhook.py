@@ -0,0 +1,214 @@
+# bench_webhook.py
+# /callback 端到端壓測：產生帶簽章的 LINE webhook 內容，以記憶體資料庫 + 假 QA 後端 + 假 LineBotApi 重播
+# 用法: python test_code/bench_webhook.py --users 500 --concurrency 16 [--async-webhook] [--llm-latency 0.05]
+#       [--events-per-body 8 --webhook-batch]（同一個 webhook 合併多個使用者的事件，搭配 WEBHOOK_BATCH 批次處理）
+# 情境: follow（只加好友）、quiz（完整五題）、wrong（先答錯再答對）、llm（答完後問社團LLM）
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHANNEL_SECRET = "bench-channel-secret"
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def sign(body):
+    """與 LINE 平台相同的簽章: base64(HMAC-SHA256(channel secret, body))"""
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+def build_event(user_id, seq, text=None):
+    event = {
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": f"{user_id}-{seq}",
+        "webhookEventId": f"{user_id}-{seq}",
+        "deliveryContext": {"isRedelivery": False},
+    }
+    if text is None:
+        event["type"] = "follow"
+    else:
+        event["type"] = "message"
+        event["message"] = {"type": "text", "id": f"{user_id}{seq}", "text": text}
+    return event
+
+
+def build_body(events):
+    return json.dumps({"destination": "bench", "events": events}, ensure_ascii=False)
+
+
+def scenario_texts(kind, gameplay, rng, kb_texts):
+    """回傳此情境依序送出的訊息，None 代表 FollowEvent"""
+    texts = [None]
+    if kind == "follow":
+        return texts
+    texts += ["那我們都在幹什麼", "我想加入！", "準備好了！"]
+    for question in range(1, 6):
+        correct = gameplay.get_correct_answer(question)
+        if kind == "wrong":
+            wrong = [option for option in gameplay.get_answer_options(question) if option != correct]
+            texts.append(rng.choice(wrong))
+        texts.append(correct)
+    if kind == "llm":
+        # 一半問知識庫內的問題（會走到生成回答），一半問隨機問題
+        question = rng.choice(kb_texts) if rng.random() < 0.5 else f"社課都在教什麼？{rng.randint(0, 50)}"
+        texts += ["@呼叫社團LLM", question, "O"]
+    return texts
+
+
+class FakeLineBotApi:
+    """取代 LineBotApi：只記錄呼叫，不送出任何請求"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def _record(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def reply_message(self, reply_token, messages, **kwargs):
+        self._record("reply_message")
+
+    def push_message(self, to, messages, **kwargs):
+        self._record("push_message")
+
+    def get_profile(self, user_id, **kwargs):
+        self._record("get_profile")
+        return type("Profile", (), {"display_name": "bench"})()
+
+    def show_loading_animation(self, user_id, seconds=20):
+        self._record("show_loading_animation")
+
+
+def setup_app(args):
+    os.environ.update({
+        "CHANNEL_TOKEN_TEST": "bench",
+        "CHANNEL_SECRET_TEST": CHANNEL_SECRET,
+        "CHANNEL_ACCESS_TOKEN_ADMIN": "bench",
+        "ADMIN_ID": "Ubench-admin",
+        "DB_BACKEND": "memory",
+        "QA_BACKEND": "fake",
+        "EMBEDDING_CACHE_PATH": "",
+        "ASYNC_WEBHOOK": "true" if args.async_webhook else "false",
+        "WEBHOOK_BATCH": "true" if args.webhook_batch else "false",
+    })
+    import main
+    import linebot_object.QA as QA
+    from linebot_object.fake_backend import FakeLatency, build_fake_knowledge_base
+
+    fake_api = FakeLineBotApi()
+    main.line_bot_api = fake_api
+    main.line_bot_api_admin = fake_api
+    QA.OpenAI_client.chat_latency = FakeLatency(args.llm_latency, args.llm_latency / 5, seed=1)
+    QA.OpenAI_client.embed_latency = FakeLatency(args.llm_latency / 4, args.llm_latency / 20, seed=2)
+    kb_texts = build_fake_knowledge_base(main.qa_collection)
+    QA.reload_qa_vectors()
+    return main, fake_api, kb_texts
+
+
+def run(args):
+    main, fake_api, kb_texts = setup_app(args)
+    import linebot_object.welcome_gameplay as gameplay
+
+    rng = random.Random(args.seed)
+    kinds = ["follow", "quiz", "wrong", "llm"]
+    weights = [args.follow_weight, args.quiz_weight, args.wrong_weight, args.llm_weight]
+    scripts = []
+    for i in range(args.users):
+        kind = rng.choices(kinds, weights)[0]
+        scripts.append((f"Ubench{i:08d}", kind, scenario_texts(kind, gameplay, rng, kb_texts)))
+
+    latencies = []
+    statuses = Counter()
+    event_count = Counter()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def play(group):
+        # 同一個使用者的事件依序送出，不同組的使用者並行；同一組使用者的第 seq 個事件合併在同一個 webhook
+        if not hasattr(local, "client"):
+            local.client = main.app.test_client()
+        for seq in range(max(len(texts) for _, _, texts in group)):
+            events = [build_event(user_id, seq, texts[seq]) for user_id, _, texts in group if seq < len(texts)]
+            body = build_body(events)
+            for attempt in range(args.max_redeliveries + 1):
+                start = time.perf_counter()
+                response = local.client.post("/callback", data=body, headers={"X-Line-Signature": sign(body)})
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[response.status_code] += 1
+                if response.status_code != 503:
+                    break
+                # 與 LINE 平台相同：非 2xx 的 webhook 稍後重送
+                time.sleep(0.05 * (attempt + 1))
+            with lock:
+                event_count["events"] += len(events)
+
+    groups = [scripts[i:i + args.events_per_body] for i in range(0, len(scripts), args.events_per_body)]
+
+    ops_before = main.client.total_ops()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(play, groups))
+    if main.event_pool is not None:
+        # 非同步模式下要等背景 lane 處理完才算完成（處理失敗的事件也算完成），最多等 --drain-timeout 秒
+        deadline = time.perf_counter() + args.drain_timeout
+        while True:
+            stats = main.event_pool.get_stats()
+            if stats["processed"] + stats["failed"] >= stats["submitted"]:
+                break
+            if time.perf_counter() > deadline:
+                print(f"警告: 等待 lane 處理逾時，仍有 {stats['submitted'] - stats['processed'] - stats['failed']} 個事件未處理")
+                break
+            time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    db_ops = main.client.total_ops() - ops_before
+
+    events = event_count["events"]
+    latencies.sort()
+    finished = main.users_collection.count_documents({"finish_gameplay": True})
+    print(f"使用者: {args.users} ({dict(Counter(kind for _, kind, _ in scripts))}), 並行數: {args.concurrency}, "
+          f"非同步 webhook: {args.async_webhook}, 每個 webhook 的事件數: {args.events_per_body}, "
+          f"批次處理: {args.webhook_batch}")
+    print(f"事件: {events} ({len(latencies)} 個 webhook), 總時間: {elapsed:.2f} 秒, 吞吐量: {events / elapsed:.0f} events/秒")
+    print(f"/callback 延遲 p50: {percentile(latencies, 0.5) * 1000:.2f} ms, "
+          f"p95: {percentile(latencies, 0.95) * 1000:.2f} ms, "
+          f"p99: {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"資料庫操作: {db_ops} 次, 平均每個事件 {db_ops / events:.2f} 次")
+    print(f"HTTP 狀態: {dict(statuses)}, LINE API 呼叫: {dict(fake_api.calls)}")
+    print(f"完成問答的使用者: {finished}")
+    main.shutdown_background_tasks()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/callback 端到端壓測")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--async-webhook", action="store_true", help="開啟 ASYNC_WEBHOOK 模式")
+    parser.add_argument("--events-per-body", type=int, default=1, help="每個 webhook 合併幾個使用者的事件")
+    parser.add_argument("--webhook-batch", action="store_true", help="開啟 WEBHOOK_BATCH 批次處理")
+    parser.add_argument("--max-redeliveries", type=int, default=10, help="收到 503 時模擬 LINE 重送的次數上限")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="非同步模式下等待 lane 處理完的秒數上限")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="假 LLM 的平均延遲（秒）")
+    parser.add_argument("--follow-weight", type=float, default=1)
+    parser.add_argument("--quiz-weight", type=float, default=4)
+    parser.add_argument("--wrong-weight", type=float, default=2)
+    parser.add_argument("--llm-weight", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
@@ -2,6 +2,10 @@ from dotenv import load_dotenv
 from openai import OpenAI
 import os
 from pymongo import MongoClient
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from linebot_object.embedding_cache import embed_with_cache
 
 load_dotenv()
 OpenAI_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -16,11 +20,8 @@ db = mongo_client["GDG-QA"]
 qa_collection = db["qa_vectors"]
 
 def embed_text(text):
-    response = OpenAI_client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
-    )
-    return response.data[0].embedding
+    """使用 OpenAI embedding 生成向量（與 bot 共用 embedding 快取）"""
+    return embed_with_cache(OpenAI_client, text)
 
 def debug_database():
     """診斷資料庫內容"""
@@ -2,6 +2,10 @@ from dotenv import load_dotenv
 from openai import OpenAI
 import os
 from pymongo import MongoClient
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from linebot_object.embedding_cache import embed_with_cache
 import json
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
@@ -21,12 +25,8 @@ db = mongo_client["GDG-QA"]
 qa_collection = db["qa_vectors"]
 
 def embed_text(text):
-    """使用 OpenAI embedding 生成向量"""
-    response = OpenAI_client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
-    )
-    return response.data[0].embedding
+    """使用 OpenAI embedding 生成向量（與 bot 共用 embedding 快取）"""
+    return embed_with_cache(OpenAI_client, text)
 def vector_search(query, limit=3, threshold=0.7):
     """向量搜尋函數"""
     if qa_collection is None:
@@ -2,9 +2,13 @@ from dotenv import load_dotenv
 from openai import OpenAI
 import os
 from pymongo import MongoClient
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from linebot_object.embedding_cache import embed_with_cache, embed_many_with_cache
 import json
+import time
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 load_dotenv()
 OpenAI_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -21,139 +25,98 @@ db = mongo_client["GDG-QA"]
 qa_collection = db["qa_vectors"]
 
 def embed_text(text):
-    """使用 OpenAI embedding 生成向量"""
-    response = OpenAI_client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
-    )
-    return response.data[0].embedding
-
-def detect_similar_aliases(qa_data, similarity_threshold=0.88):
-    """
-    檢測 QA 內部 aliases 的相似度，只報告不移除
-    """
-    print(f"\n=== QA內部 Aliases 相似度檢測 (相似度閾值: {similarity_threshold}) ===")
-    
-    similarity_report = []
-    
-    for item_idx, item in enumerate(qa_data):
-        print(f"\n檢測 QA 項目 {item_idx + 1}: 「{item['label']}」")
-        aliases_count = len(item["aliases"])
-        print(f"Aliases 數量: {aliases_count}")
-        
-        if aliases_count <= 1:
-            print("Aliases 數量不足，跳過相似度檢測")
-            continue
-            
-        # 生成所有 aliases 的 embeddings
-        aliases = item["aliases"]
-        print("正在生成 embeddings...")
-        embeddings = []
-        for alias in aliases:
-            embedding = embed_text(alias)
-            embeddings.append(embedding)
-        
-        # 檢測相似的 aliases 組合
-        similar_pairs = []
-        
-        for i in range(len(aliases)):
-            for j in range(i + 1, len(aliases)):
-                similarity = cosine_similarity([embeddings[i]], [embeddings[j]])[0][0]
-                
-                if similarity > similarity_threshold:
-                    similar_pair = {
-                        "alias_1": aliases[i],
-                        "alias_2": aliases[j],
-                        "similarity": similarity
-                    }
-                    similar_pairs.append(similar_pair)
-
-        if similar_pairs:
-            qa_similarity = {
-                "qa_label": item["label"],
-                "qa_index": item_idx,
-                "total_aliases": aliases_count,
-                "similar_pairs": similar_pairs,
-                "similar_pairs_count": len(similar_pairs)
-            }
-            similarity_report.append(qa_similarity)
-        else:
-            print(" 沒有發現相似的 aliases")
-    
-    print(f"\n=== Aliases 相似度檢測完成 ===")
-    print(f"總共在 {len(similarity_report)} 個 QA 項目中發現相似的 aliases")
-    
-    return similarity_report
+    """使用 OpenAI embedding 生成向量（與 bot 共用 embedding 快取）"""
+    return embed_with_cache(OpenAI_client, text)
 
-def detect_cross_qa_similarities(qa_data, similarity_threshold=0.85):
-    """
-    檢測跨 QA 項目的相似問題，只報告不移除
+def build_similarity_index(qa_data):
+    """把所有 label / alias 一次 embedding 成 (n, d) 矩陣，每列做 L2 正規化
+
+    回傳 (texts, qa_index, is_label, matrix)，qa_index / is_label 為之後做遮罩用的陣列
     """
-    print(f"\n=== 跨 QA 項目相似度檢測 (相似度閾值: {similarity_threshold}) ===")
-    
-    # 收集所有問題文本和其對應的 QA 索引
-    all_questions = []  # (問題文本, qa_index, question_type)
-    
+    texts = []
+    qa_index = []
+    is_label = []
     for qa_idx, qa_item in enumerate(qa_data):
-        # 主要 label
-        all_questions.append((qa_item["label"], qa_idx, "label"))
-        
-        # 所有 aliases
-        for alias_idx, alias in enumerate(qa_item["aliases"]):
-            all_questions.append((alias, qa_idx, "alias"))
-    
-    print(f"總共收集到 {len(all_questions)} 個問題文本")
-    
-    # 生成所有問題的 embeddings
-    print("正在生成所有問題的 embeddings...")
-    embeddings = []
-    for question_text, _, _ in all_questions:
-        embedding = embed_text(question_text)
-        embeddings.append(embedding)
-    
-    # 尋找相似的問題組合
-    print("正在分析跨 QA 相似問題...")
-    similar_pairs = []
-    
-    for i in range(len(all_questions)):
-        question_i = all_questions[i]
-        embedding_i = embeddings[i]
-        
-        for j in range(i + 1, len(all_questions)):
-            question_j = all_questions[j]
-            embedding_j = embeddings[j]
-            
-            if question_i[1] == question_j[1]:
-                print(f"  跳過同一 QA 內部比較: [{question_i[1]}] {question_i[0]} vs {question_j[0]}")
-                continue
-            if question_i[2] == "label" or question_j[2] == "label":
-                print(f"  跳過Label : [{question_i[1]}] {question_i[0]} vs {question_j[0]}")
-                continue
-            
-            # 計算相似度
-            similarity = cosine_similarity([embedding_i], [embedding_j])[0][0]
-            
-            if similarity > similarity_threshold:
-                similar_pair = {
+        texts.append(qa_item["label"])
+        qa_index.append(qa_idx)
+        is_label.append(True)
+        for alias in qa_item["aliases"]:
+            texts.append(alias)
+            qa_index.append(qa_idx)
+            is_label.append(False)
+
+    print(f"總共收集到 {len(texts)} 個問題文本，正在批次生成 embeddings...")
+    matrix = np.asarray(embed_many_with_cache(OpenAI_client, texts), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return texts, np.asarray(qa_index), np.asarray(is_label), matrix
+
+def scan_similar_pairs(matrix, qa_index, is_label, aliases_threshold, cross_qa_threshold, block_size=1024):
+    """分塊計算相似度矩陣的上三角，依序產生 (種類, i, j, 相似度)
+
+    - "alias": 同一個 QA 內的兩個 aliases，相似度超過 aliases_threshold
+    - "cross_qa": 不同 QA 的兩個 aliases（不含 label），相似度超過 cross_qa_threshold
+    """
+    n = matrix.shape[0]
+    is_alias = ~is_label
+    for row_start in range(0, n, block_size):
+        row_end = min(row_start + block_size, n)
+        rows = np.arange(row_start, row_end)
+        # 只需要 j > i 的部分，因此每塊只和自己之後的列相乘
+        cols = np.arange(row_start, n)
+        sims = matrix[row_start:row_end] @ matrix[row_start:].T
+
+        upper = cols[None, :] > rows[:, None]
+        alias_pair = is_alias[rows][:, None] & is_alias[cols][None, :]
+        same_qa = qa_index[rows][:, None] == qa_index[cols][None, :]
+
+        masks = (
+            ("alias", upper & alias_pair & same_qa & (sims > aliases_threshold)),
+            ("cross_qa", upper & alias_pair & ~same_qa & (sims > cross_qa_threshold)),
+        )
+        for kind, mask in masks:
+            for i, j in zip(*np.nonzero(mask)):
+                yield kind, int(rows[i]), int(cols[j]), float(sims[i, j])
+
+def detect_similarities(qa_data, aliases_threshold=0.88, cross_qa_threshold=0.85, stream_path="qa_similarity_pairs.jsonl"):
+    """檢測 QA 內部 aliases 與跨 QA 的相似問題，只報告不移除；找到的組合即時寫入 stream_path"""
+    print(f"\n=== 相似度檢測 (aliases 閾值: {aliases_threshold}, 跨 QA 閾值: {cross_qa_threshold}) ===")
+    start = time.time()
+    texts, qa_index, is_label, matrix = build_similarity_index(qa_data)
+
+    alias_pairs_by_qa = {}
+    cross_qa_similarities = []
+    with open(stream_path, "w", encoding="utf-8") as stream:
+        for kind, i, j, similarity in scan_similar_pairs(matrix, qa_index, is_label, aliases_threshold, cross_qa_threshold):
+            if kind == "alias":
+                pair = {"alias_1": texts[i], "alias_2": texts[j], "similarity": similarity}
+                alias_pairs_by_qa.setdefault(int(qa_index[i]), []).append(pair)
+            else:
+                pair = {
                     "similarity": similarity,
-                    "question_1": {
-                        "qa_label": qa_data[question_i[1]]["label"],
-                        "text": question_i[0],
-                        "qa_index": question_i[1],
-                    },
-                    "question_2": {
-                        "qa_label": qa_data[question_j[1]]["label"],
-                        "text": question_j[0],
-                        "qa_index": question_j[1],
-                    }
+                    "question_1": {"qa_label": qa_data[qa_index[i]]["label"], "text": texts[i], "qa_index": int(qa_index[i])},
+                    "question_2": {"qa_label": qa_data[qa_index[j]]["label"], "text": texts[j], "qa_index": int(qa_index[j])},
                 }
-                
-                similar_pairs.append(similar_pair)
+                cross_qa_similarities.append(pair)
+            stream.write(json.dumps({"type": kind, **pair}, ensure_ascii=False) + "\n")
 
-    print(f"\n=== 跨 QA 相似度檢測完成 ===")
-    print(f"發現 {len(similar_pairs)} 組跨 QA 相似問題")
-    
-    return similar_pairs
+    aliases_similarities = [
+        {
+            "qa_label": qa_data[qa_idx]["label"],
+            "qa_index": qa_idx,
+            "total_aliases": len(qa_data[qa_idx]["aliases"]),
+            "similar_pairs": pairs,
+            "similar_pairs_count": len(pairs)
+        }
+        for qa_idx, pairs in sorted(alias_pairs_by_qa.items())
+    ]
+
+    print(f"\n=== 相似度檢測完成 ({time.time() - start:.2f} 秒，{len(texts)} 個文本) ===")
+    print(f"總共在 {len(aliases_similarities)} 個 QA 項目中發現相似的 aliases")
+    print(f"發現 {len(cross_qa_similarities)} 組跨 QA 相似問題")
+    print(f"相似組合已即時寫入 {stream_path}")
+    return aliases_similarities, cross_qa_similarities
 
 def create_similarity_report(aliases_similarities, cross_qa_similarities):
     
@@ -195,8 +158,7 @@ def detect_qa_similarities_comprehensive(aliases_threshold=0.88, cross_qa_thresh
     print(f"載入了 {len(qa_data)} 個 QA 項目")
     
     # 開始確認相似度
-    aliases_similarities = detect_similar_aliases(qa_data, aliases_threshold)
-    cross_qa_similarities = detect_cross_qa_similarities(qa_data, cross_qa_threshold)
+    aliases_similarities, cross_qa_similarities = detect_similarities(qa_data, aliases_threshold, cross_qa_threshold)
     similarity_report = create_similarity_report(aliases_similarities, cross_qa_similarities)
     
     # 儲存相似度檢測報告